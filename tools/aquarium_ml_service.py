@@ -38,22 +38,54 @@ Systemd Service:
 """
 
 import argparse
+import csv
+import hashlib
 import json
 import logging
 import os
 import signal
 import sys
+import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Tuple
 
+import joblib
 import mysql.connector
+from mysql.connector import errorcode
 import numpy as np
 import paho.mqtt.client as mqtt
-from sklearn.ensemble import GradientBoostingRegressor, RandomForestRegressor
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+# Optional: orjson serialises MQTT payloads straight to bytes and understands
+# NumPy scalars; the stdlib json module is used when it is not installed.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Optional: Intel Extension for Scikit-learn replaces the estimators below with
+# oneDAL-backed versions on x86. It must patch before they are imported.
+try:
+    from sklearnex import patch_sklearn
+    patch_sklearn()
+except ImportError:
+    pass
+
+from sklearn.ensemble import GradientBoostingRegressor, HistGradientBoostingRegressor
 from sklearn.linear_model import LinearRegression
 from sklearn.preprocessing import StandardScaler
 
+try:
+    from mysql.connector.connection_cext import CMySQLConnection  # noqa: F401
+    HAVE_MYSQL_CEXT = True
+except ImportError:
+    HAVE_MYSQL_CEXT = False
+
 # ============================================================================
 # Configuration
 # ============================================================================
@@ -64,6 +96,7 @@ MQTT_PORT = int(os.getenv("MQTT_PORT", "1883"))
 MQTT_USER = os.getenv("MQTT_USER", "")
 MQTT_PASSWORD = os.getenv("MQTT_PASSWORD", "")
 MQTT_TOPIC_PREFIX = os.getenv("MQTT_TOPIC_PREFIX", "aquarium")
+MQTT_KEEPALIVE = 30  # seconds; a dead broker link is noticed within ~1.5x this
 
 # MQTT Topics
 TOPIC_SENSOR_DATA = f"{MQTT_TOPIC_PREFIX}/data"
@@ -73,6 +106,21 @@ TOPIC_WC_HISTORY = f"{MQTT_TOPIC_PREFIX}/waterchange/history"
 TOPIC_WC_EVENT = f"{MQTT_TOPIC_PREFIX}/waterchange/event"
 TOPIC_WC_PREDICTION = f"{MQTT_TOPIC_PREFIX}/ml/prediction"
 TOPIC_FILTER_MAINTENANCE = f"{MQTT_TOPIC_PREFIX}/filter/maintenance"
+TOPIC_ML_STATUS = f"{MQTT_TOPIC_PREFIX}/ml/status"
+
+# Sensor data arrives every few seconds and a missed reading is harmless, so
+# everything is subscribed at QoS 0 in a single SUBSCRIBE packet
+MQTT_SUBSCRIPTIONS = [
+    (TOPIC_SENSOR_DATA, 0),
+    (TOPIC_PID_PERFORMANCE, 0),
+    (TOPIC_WC_EVENT, 0),
+    (TOPIC_WC_HISTORY, 0),
+    (TOPIC_FILTER_MAINTENANCE, 0)
+]
+
+# Retained water change predictions expire on the broker (MQTT 5) if no newer
+# one replaces them, so a stalled service cannot leave a stale forecast behind
+WC_PREDICTION_EXPIRY = 48 * 3600
 
 # MariaDB Configuration
 DB_HOST = os.getenv("DB_HOST", "localhost")
@@ -80,14 +128,49 @@ DB_PORT = int(os.getenv("DB_PORT", "3306"))
 DB_NAME = os.getenv("DB_NAME", "aquarium")
 DB_USER = os.getenv("DB_USER", "aquarium")
 DB_PASSWORD = os.getenv("DB_PASSWORD", "aquarium")
+DB_UNIX_SOCKET = os.getenv("DB_UNIX_SOCKET", "/var/run/mysqld/mysqld.sock")
+BULK_INSERT_BATCH_SIZE = 10000  # Rows per multi-row INSERT, well under max_allowed_packet
+FETCH_BATCH_SIZE = 4096          # Rows per fetchmany() when streaming into NumPy buffers
+DB_PING_INTERVAL = 30            # Seconds a connection is trusted before is_connected() pings it
+SENSOR_BUFFER_ROWS = 50          # Buffered sensor readings written per batch...
+SENSOR_BUFFER_SECONDS = 2.0      # ...or sooner once the oldest has waited this long
+
+# PID performance history as a struct-of-arrays record, one field per column.
+# Missing feature values default in SQL; NULL metrics become NaN.
+PID_HISTORY_DTYPE = np.dtype([
+    ('timestamp', 'i8'),
+    ('kp', 'f8'),
+    ('ki', 'f8'),
+    ('kd', 'f8'),
+    ('settling_time', 'f8'),
+    ('overshoot', 'f8'),
+    ('temperature', 'f8'),
+    ('ambient_temp', 'f8'),
+    ('tds', 'f8'),
+    ('ph', 'f8'),
+    ('hour', 'i4'),
+    ('tank_volume', 'f8'),
+])
 
 # Training Parameters
 MIN_PID_SAMPLES = 50           # Minimum samples for PID training
 MIN_WC_SAMPLES = 5             # Minimum water changes for prediction
 PID_TRAIN_INTERVAL = 6 * 3600  # Train PID every 6 hours
 WC_TRAIN_INTERVAL = 24 * 3600  # Train water change predictor daily
+SERVICE_TICK = 60  # Longest the service loop sleeps between schedule checks
+WC_RETRAIN_FRACTION = 0.2      # ...or sooner once new events reach this share of the fitted samples
+PID_TRAIN_HISTORY = 1000       # Newest PID performance rows fitted per season
+WC_TRAIN_HISTORY = 100         # Newest water changes fitted; bounds training time as history grows
+WC_BAKEOFF_EVERY = 5           # Retrains between full model bake-offs; in between only champion + one challenger fit
+WC_PROMOTE_MARGIN = 0.02       # R² a challenger must gain over the champion to replace it
 CONFIDENCE_THRESHOLD = 0.6      # Minimum confidence to publish predictions
 
+# Fitted models are cached here keyed by their training data; empty disables
+MODEL_CACHE_DIR = os.getenv("MODEL_CACHE_DIR", "/var/cache/aquarium-ml")
+WC_AMBIENT_TOLERANCE = 0.5  # °C of ambient drift tolerated before an unchanged history is refit
+WC_CACHE_VERSION = 2  # bump when cached models stop matching how predict() feeds them
+PID_CACHE_VERSION = 1  # same, for the per-season PID models
+
 # Logging
 logging.basicConfig(
     level=logging.INFO,
@@ -102,6 +185,10 @@ logger = logging.getLogger(__name__)
 # Global shutdown flag
 shutdown_requested = False
 
+# Wakes the service loop before SERVICE_TICK: set on shutdown and when enough
+# new water change events arrive over MQTT to retrain early
+service_wakeup = threading.Event()
+
 
 # ============================================================================
 # Database Manager
@@ -110,7 +197,8 @@ shutdown_requested = False
 class AquariumDatabase:
     """Unified database manager for all ML operations"""
     
-    def __init__(self, host: str, port: int, database: str, user: str, password: str):
+    def __init__(self, host: str, port: int, database: str, user: str, password: str,
+                 allow_local_infile: bool = False, create_tables: bool = True):
         self.db_config = {
             'host': host,
             'port': port,
@@ -118,16 +206,51 @@ class AquariumDatabase:
             'user': user,
             'password': password,
             'autocommit': True,
-            'pool_name': 'aquarium_pool',
-            'pool_size': 5
+            'pool_size': 5,
+            # Skip COM_RESET_CONNECTION on every return to the pool; _release()
+            # hands connections back clean instead
+            'pool_reset_session': False,
+            'allow_local_infile': allow_local_infile,
+            'use_pure': not HAVE_MYSQL_CEXT  # Prefer the C extension when it loads
         }
+        
+        # Local server: skip the TCP loopback stack and talk over the Unix socket.
+        # Remote server: compress the protocol so bulk inserts put fewer bytes on the wire.
+        if host in ('localhost', '127.0.0.1') and os.path.exists(DB_UNIX_SOCKET):
+            self.db_config['unix_socket'] = DB_UNIX_SOCKET
+        else:
+            self.db_config['compress'] = True
+        
+        # Pools are global to the connector and looked up by name: instances
+        # with different settings (database, allow_local_infile, transport)
+        # need their own, while identical ones may share
+        pool_key = repr(sorted((k, v) for k, v in self.db_config.items() if k != 'password'))
+        self.db_config['pool_name'] = 'aquarium_' + hashlib.blake2b(
+            pool_key.encode(), digest_size=8).hexdigest()
+        
         self.conn = None
-        self._init_database()
+        self._in_transaction = False
+        self._prepared = {}  # SQL -> server-side prepared cursor on self.conn
+        self._last_ping = 0.0  # monotonic time the connection was last known good
+        self._sensor_buffer = []  # sensor_readings rows awaiting one batched INSERT
+        self._sensor_buffer_since = 0.0
+        # Only the MQTT writer thread fills and flushes the buffer (readers go
+        # through MQTTManager.flush_sensor_readings); close() flushes the rest
+        # once that thread has stopped. The lock keeps append and swap atomic
+        # should a caller flush from elsewhere.
+        self._sensor_buffer_lock = threading.Lock()
+        self._init_database(create_tables)
     
-    def _init_database(self):
-        """Initialize database and create all required tables"""
+    def _init_database(self, create_tables: bool = True):
+        """Initialize database and create all required tables
+        
+        With create_tables=False only the connection is opened, for extra
+        instances (e.g. one per thread) once the schema is in place.
+        """
         try:
             self.conn = mysql.connector.connect(**self.db_config)
+            if not create_tables:
+                return
             cursor = self.conn.cursor()
             
             # Sensor readings table
@@ -204,6 +327,19 @@ class AquariumDatabase:
                 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
             ''')
             
+            # "Latest N completed changes" (training, prediction, fingerprint)
+            # read the top of this index without touching the table rows.
+            # Created separately so databases from earlier versions get it too;
+            # MySQL has no CREATE INDEX IF NOT EXISTS, so a duplicate is ignored.
+            try:
+                cursor.execute('''
+                    CREATE INDEX idx_wc_completed_end
+                    ON water_changes (completed, end_timestamp, tds_before, tds_after, volume_litres)
+                ''')
+            except mysql.connector.Error as e:
+                if e.errno != errorcode.ER_DUP_KEYNAME:
+                    raise
+            
             # Filter maintenance
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS filter_maintenance (
@@ -236,85 +372,344 @@ class AquariumDatabase:
             logger.info("Database initialized successfully")
             
         except mysql.connector.Error as e:
-            logger.error(f"Database initialization error: {e}")
+            logger.error("Database initialization error: %s", e)
             raise
     
     def reconnect(self):
         """Reconnect to database if connection is lost"""
         try:
-            if self.conn:
-                self.conn.close()
+            self._release()
             self.conn = mysql.connector.connect(**self.db_config)
+            self._last_ping = time.monotonic()
             logger.info("Database reconnected")
         except mysql.connector.Error as e:
-            logger.error(f"Database reconnection error: {e}")
+            logger.error("Database reconnection error: %s", e)
             raise
     
     def ensure_connection(self):
-        """Ensure database connection is active"""
+        """Ensure database connection is active
+        
+        is_connected() costs a COM_PING round trip, so a connection that was
+        verified within DB_PING_INTERVAL seconds is reused without asking.
+        """
+        if self.conn and time.monotonic() - self._last_ping < DB_PING_INTERVAL:
+            return
         try:
             if not self.conn or not self.conn.is_connected():
                 self.reconnect()
         except:
             self.reconnect()
+        self._last_ping = time.monotonic()
+    
+    def _release(self):
+        """Hand self.conn back to the pool with no session state left behind
+        
+        pool_reset_session=False means the next borrower gets the session
+        exactly as it is returned, so every path that gives a connection back
+        goes through here: prepared statements are deallocated and an open
+        transaction is rolled back. Session variables are restored by
+        whoever sets them (load_csv). Errors are ignored, as a dead
+        connection has nothing left to clean up.
+        """
+        self._close_prepared()
+        if not self.conn:
+            return
+        if self._in_transaction:
+            self._in_transaction = False
+            try:
+                self.conn.rollback()
+            except Exception:
+                pass
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+    
+    def _close_prepared(self):
+        """Close every prepared cursor, deallocating its server-side statement
+        
+        The pool does not reset sessions (pool_reset_session=False), so
+        statements left open would pile up on the reused connection. Errors
+        are ignored: on a dead connection there is nothing left to free.
+        """
+        for cursor in self._prepared.values():
+            try:
+                cursor.close()
+            except Exception:
+                pass
+        self._prepared.clear()
+    
+    def _execute_write(self, sql: str, params, prepared: bool = False, many: bool = False) -> int:
+        """Run one write statement, retrying once if the connection has dropped
+        
+        ensure_connection() trusts a connection for DB_PING_INTERVAL seconds,
+        so a server restart inside that window shows up here as an
+        OperationalError or InterfaceError. The trust is revoked and the
+        statement replayed once on a checked connection. Inside an explicit
+        transaction the earlier statements died with the old session, so the
+        error is raised rather than replayed on its own.
+        
+        Returns the cursor's rowcount.
+        """
+        for attempt in range(2):
+            self.ensure_connection()
+            cursor = self._prepared_cursor(sql) if prepared else self.conn.cursor()
+            try:
+                if many:
+                    cursor.executemany(sql, params)
+                else:
+                    cursor.execute(sql, params)
+                return cursor.rowcount
+            except (mysql.connector.OperationalError, mysql.connector.InterfaceError) as e:
+                if attempt or self._in_transaction:
+                    raise
+                logger.warning("Database connection lost, retrying write: %s", e)
+                self._last_ping = 0.0
+    
+    def _prepared_cursor(self, sql: str):
+        """Return a prepared cursor for sql, preparing it once per connection
+        
+        Used for the single-row inserts that run on every MQTT message and
+        the history reads each training run repeats; the server parses the
+        statement once and each call is one binary COM_STMT_EXECUTE. Bulk
+        paths stay on the text cursor because executemany rewrites an INSERT
+        into a single multi-row statement.
+        """
+        cursor = self._prepared.get(sql)
+        if cursor is None:
+            cursor = self.conn.cursor(prepared=True)
+            self._prepared[sql] = cursor
+        return cursor
     
     # ========================================================================
-    # Sensor Data Methods
+    # Transactions
     # ========================================================================
     
-    def store_sensor_reading(self, data: Dict):
-        """Store a sensor reading"""
+    def begin(self):
+        """Open an explicit transaction; store_* calls defer their commit until commit()"""
         self.ensure_connection()
-        cursor = self.conn.cursor()
+        self.conn.start_transaction()
+        self._in_transaction = True
+    
+    def commit(self):
+        """Commit the open transaction"""
+        self._in_transaction = False
+        self.conn.commit()
+    
+    def rollback(self):
+        """Discard the open transaction"""
+        self._in_transaction = False
+        self.conn.rollback()
+    
+    @contextmanager
+    def transaction(self):
+        """Group several store_* calls into one transaction (one commit/fsync)
+        
+        Outside a transaction store_* methods log a failed write and carry on;
+        inside one they re-raise it, so the block rolls back as a whole
+        instead of committing the writes that did succeed.
+        """
+        self.begin()
         try:
-            cursor.execute('''
-                INSERT INTO sensor_readings 
-                (timestamp, temperature, ambient_temp, ph, tds, heater_state, co2_state)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-            ''', (
-                data.get('timestamp', int(time.time())),
-                data.get('temperature'),
-                data.get('ambientTemp'),
-                data.get('ph'),
-                data.get('tds'),
-                1 if data.get('heaterState') == 'ON' else 0,
-                1 if data.get('co2State') == 'ON' else 0
-            ))
+            yield self
+            self.commit()
+        except Exception:
+            self.rollback()
+            raise
+    
+    def _autocommit(self):
+        """Commit a single store_* write unless an explicit transaction is open"""
+        if not self._in_transaction:
             self.conn.commit()
+    
+    # ========================================================================
+    # Bulk Loading
+    # ========================================================================
+    
+    def _executemany(self, sql: str, params: List[Tuple]) -> int:
+        """Run executemany in BULK_INSERT_BATCH_SIZE chunks and return the rows inserted
+        
+        Each chunk is rewritten into one multi-row INSERT, so capping it keeps
+        every statement under the server's max_allowed_packet however large
+        the batch grows. A dropped connection costs only the chunk in flight,
+        which _execute_write replays.
+        """
+        inserted = 0
+        for start in range(0, len(params), BULK_INSERT_BATCH_SIZE):
+            inserted += self._execute_write(sql, params[start:start + BULK_INSERT_BATCH_SIZE], many=True)
+        return inserted
+    
+    def load_csv(self, table: str, columns: List[str], rows: List[Tuple]) -> int:
+        """Stream rows into a table with LOAD DATA LOCAL INFILE
+        
+        Faster than a multi-row INSERT for large synthetic or imported batches
+        because the server skips SQL parsing. None values are written as \\N
+        so they load as NULL. Unique and foreign key checks are switched off
+        for the session while loading so InnoDB does not probe them per row.
+        Requires allow_local_infile=True.
+        
+        Returns the number of rows loaded.
+        """
+        if not rows:
+            return 0
+        
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', newline='', delete=False) as f:
+            writer = csv.writer(f)
+            writer.writerows(
+                ['\\N' if v is None else v for v in row] for row in rows
+            )
+            path = f.name
+        
+        self.ensure_connection()
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute("SET unique_checks=0, foreign_key_checks=0")
+            cursor.execute(f'''
+                LOAD DATA LOCAL INFILE %s INTO TABLE {table}
+                FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '"'
+                LINES TERMINATED BY '\\r\\n'
+                ({', '.join(columns)})
+            ''', (path,))
+            loaded = cursor.rowcount
+            self._autocommit()
+            logger.debug("Loaded %s rows into %s", loaded, table)
+            return loaded
         except mysql.connector.Error as e:
-            logger.error(f"Error storing sensor reading: {e}")
+            logger.error("Error loading rows into %s: %s", table, e)
+            return 0
+        finally:
+            try:
+                cursor.execute("SET unique_checks=1, foreign_key_checks=1")
+            except mysql.connector.Error as e:
+                logger.error("Error restoring constraint checks: %s", e)
+            os.unlink(path)
+    
+    # ========================================================================
+    # Sensor Data Methods
+    # ========================================================================
+    
+    SENSOR_READING_INSERT_SQL = '''
+        INSERT INTO sensor_readings 
+        (timestamp, temperature, ambient_temp, ph, tds, heater_state, co2_state)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+    '''
     
-    def get_recent_sensor_readings(self, hours: int = 24) -> List[Dict]:
-        """Get sensor readings from the last N hours"""
+    def store_sensor_reading(self, data: Dict):
+        """Store a sensor reading
+        
+        Readings arrive on every MQTT sensor message, so they are buffered and
+        written with one autocommitted executemany once SENSOR_BUFFER_ROWS have
+        accumulated or the oldest is SENSOR_BUFFER_SECONDS old. Inside an
+        explicit transaction the row is written immediately instead.
+        """
+        row = (
+            data.get('timestamp', int(time.time())),
+            data.get('temperature'),
+            data.get('ambientTemp'),
+            data.get('ph'),
+            data.get('tds'),
+            1 if data.get('heaterState') == 'ON' else 0,
+            1 if data.get('co2State') == 'ON' else 0
+        )
+        
+        if not self._in_transaction:
+            with self._sensor_buffer_lock:
+                if not self._sensor_buffer:
+                    self._sensor_buffer_since = time.monotonic()
+                self._sensor_buffer.append(row)
+                due = len(self._sensor_buffer) >= SENSOR_BUFFER_ROWS or \
+                    time.monotonic() - self._sensor_buffer_since >= SENSOR_BUFFER_SECONDS
+            if due:
+                self.flush_sensor_readings()
+            return
+        
+        try:
+            self._execute_write(self.SENSOR_READING_INSERT_SQL, row, prepared=True)
+        except mysql.connector.Error as e:
+            logger.error("Error storing sensor reading: %s", e)
+            if self._in_transaction:
+                raise
+    
+    def flush_sensor_readings(self) -> int:
+        """Write any buffered sensor readings; returns the number inserted"""
+        with self._sensor_buffer_lock:
+            rows, self._sensor_buffer = self._sensor_buffer, []
+        return self.store_sensor_readings_bulk(rows)
+    
+    def store_sensor_readings_bulk(self, rows: List[Tuple]) -> int:
+        """Store many sensor readings with one executemany
+        
+        Telemetry relies on the connection's autocommit: each INSERT is
+        durable on its own and no COMMIT round trip follows it. Losing a
+        partial batch to a crash costs a few seconds of readings.
+        
+        Rows are raw tuples already in sensor_readings column order
+        (timestamp, temperature, ambient_temp, ph, tds, heater_state, co2_state)
+        with the states as 0/1, so callers can zip precomputed columns straight
+        in without building a payload dict per reading.
+        
+        Returns the number of rows inserted.
+        """
+        if not rows:
+            return 0
+        
+        try:
+            inserted = self._executemany(self.SENSOR_READING_INSERT_SQL, rows)
+            logger.debug("Stored %s sensor readings", inserted)
+            return inserted
+        except mysql.connector.Error as e:
+            logger.error("Error storing sensor readings: %s", e)
+            if self._in_transaction:
+                raise
+            return 0
+    
+    def get_sensor_averages(self, hours: int = 24) -> Dict[str, Optional[float]]:
+        """Average each sensor over the last N hours in one aggregate query
+        
+        Only the summary crosses the wire instead of every raw reading. Zero
+        readings are skipped like missing ones (NULLIF); a sensor with no usable
+        readings averages to None. 'count' is the number of readings in the window.
+        Readings still in the MQTT writer's buffer are not seen; flush them with
+        MQTTManager.flush_sensor_readings(wait=True) first.
+        """
         self.ensure_connection()
         cursor = self.conn.cursor()
         end_ts = int(time.time())
         start_ts = end_ts - (hours * 3600)
         
         cursor.execute('''
-            SELECT * FROM sensor_readings 
+            SELECT AVG(NULLIF(temperature, 0)), AVG(NULLIF(ambient_temp, 0)),
+                   AVG(NULLIF(ph, 0)), AVG(NULLIF(tds, 0)), COUNT(*)
+            FROM sensor_readings
             WHERE timestamp BETWEEN %s AND %s
-            ORDER BY timestamp ASC
         ''', (start_ts, end_ts))
         
-        columns = [desc[0] for desc in cursor.description]
-        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+        temperature, ambient_temp, ph, tds, count = cursor.fetchone()
+        averages = {
+            'temperature': temperature,
+            'ambient_temp': ambient_temp,
+            'ph': ph,
+            'tds': tds
+        }
+        averages = {k: None if v is None else float(v) for k, v in averages.items()}
+        averages['count'] = count
+        return averages
     
     # ========================================================================
     # PID Performance Methods
     # ========================================================================
     
+    PID_PERFORMANCE_INSERT_SQL = '''
+        INSERT INTO pid_performance 
+        (timestamp, controller, kp, ki, kd, settling_time, overshoot, 
+         steady_state_error, temperature, ambient_temp, tds, ph, hour, season, tank_volume)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    '''
+    
     def store_pid_performance(self, data: Dict):
         """Store PID performance data"""
-        self.ensure_connection()
-        cursor = self.conn.cursor()
         try:
-            cursor.execute('''
-                INSERT INTO pid_performance 
-                (timestamp, controller, kp, ki, kd, settling_time, overshoot, 
-                 steady_state_error, temperature, ambient_temp, tds, ph, hour, season, tank_volume)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ''', (
+            self._execute_write(self.PID_PERFORMANCE_INSERT_SQL, (
                 data.get('timestamp', int(time.time())),
                 data['controller'],
                 data['kp'], data['ki'], data['kd'],
@@ -328,127 +723,281 @@ class AquariumDatabase:
                 data.get('hour'),
                 data.get('season'),
                 data.get('tank_volume')
-            ))
-            self.conn.commit()
-            logger.debug(f"Stored PID performance for {data['controller']}")
+            ), prepared=True)
+            self._autocommit()
+            logger.debug("Stored PID performance for %s", data['controller'])
         except mysql.connector.Error as e:
-            logger.error(f"Error storing PID performance: {e}")
+            logger.error("Error storing PID performance: %s", e)
+            if self._in_transaction:
+                raise
     
     def get_pid_performance_history(self, controller: str, season: Optional[int] = None, 
-                                    limit: int = 1000) -> List[Dict]:
-        """Get PID performance history for a controller and optional season"""
+                                    limit: int = 1000) -> np.ndarray:
+        """Get PID performance history for a controller and optional season
+        
+        Rows are streamed with fetchmany() into a pre-allocated record array
+        of PID_HISTORY_DTYPE, so callers index columns (history['kp']) rather
+        than building a dict per row.
+        """
         self.ensure_connection()
         cursor = self.conn.cursor()
         
+        where = 'controller = %s'
+        params = [controller]
         if season is not None:
-            cursor.execute('''
-                SELECT * FROM pid_performance 
-                WHERE controller = %s AND season = %s
-                ORDER BY timestamp DESC 
-                LIMIT %s
-            ''', (controller, season, limit))
-        else:
-            cursor.execute('''
-                SELECT * FROM pid_performance 
-                WHERE controller = %s
-                ORDER BY timestamp DESC 
-                LIMIT %s
-            ''', (controller, limit))
-        
-        columns = [desc[0] for desc in cursor.description]
-        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+            where += ' AND season = %s'
+            params.append(season)
+        params.append(limit)
+        
+        cursor.execute(f'''
+            SELECT timestamp, kp, ki, kd, settling_time, overshoot,
+                   COALESCE(temperature, 25.0), COALESCE(ambient_temp, 22.0),
+                   COALESCE(tds, 300.0), COALESCE(ph, 7.0),
+                   COALESCE(hour, 12), COALESCE(tank_volume, 200.0)
+            FROM pid_performance 
+            WHERE {where}
+            ORDER BY timestamp DESC 
+            LIMIT %s
+        ''', tuple(params))
+        
+        history = np.empty(limit, dtype=PID_HISTORY_DTYPE)
+        count = 0
+        while True:
+            rows = cursor.fetchmany(FETCH_BATCH_SIZE)
+            if not rows:
+                break
+            history[count:count + len(rows)] = rows
+            count += len(rows)
+        return history[:count]
     
     def store_pid_gains(self, controller: str, kp: float, ki: float, kd: float,
                        confidence: float, model_type: str, season: int):
         """Store optimized PID gains"""
-        self.ensure_connection()
-        cursor = self.conn.cursor()
         try:
-            cursor.execute('''
+            self._execute_write('''
                 INSERT INTO pid_gains 
                 (timestamp, controller, kp, ki, kd, confidence, model_type, season)
                 VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
             ''', (int(time.time()), controller, kp, ki, kd, confidence, model_type, season))
-            self.conn.commit()
-            logger.info(f"Stored {controller} gains for season {season}: Kp={kp:.3f}, Ki={ki:.3f}, Kd={kd:.3f}")
+            self._autocommit()
+            logger.info("Stored %s gains for season %s: Kp=%.3f, Ki=%.3f, Kd=%.3f", controller, season, kp, ki, kd)
         except mysql.connector.Error as e:
-            logger.error(f"Error storing PID gains: {e}")
+            logger.error("Error storing PID gains: %s", e)
+            if self._in_transaction:
+                raise
     
     # ========================================================================
     # Water Change Methods
     # ========================================================================
     
+    WATER_CHANGE_INSERT_SQL = '''
+        INSERT INTO water_changes 
+        (start_timestamp, end_timestamp, volume_litres, 
+         temp_before, temp_after, ph_before, ph_after, 
+         tds_before, tds_after, duration_minutes, completed)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    '''
+    
+    @staticmethod
+    def _water_change_params(wc_data: Dict) -> Tuple:
+        """Map an ESP32 water change payload onto the water_changes columns"""
+        return (
+            wc_data.get('startTime'),
+            wc_data.get('endTime'),
+            wc_data.get('volume'),
+            wc_data.get('tempBefore'),
+            wc_data.get('tempAfter'),
+            wc_data.get('phBefore'),
+            wc_data.get('phAfter'),
+            wc_data.get('tdsBefore'),
+            wc_data.get('tdsAfter'),
+            wc_data.get('duration'),
+            1 if wc_data.get('successful', True) else 0
+        )
+    
     def store_water_change(self, wc_data: Dict):
         """Store a water change event"""
-        self.ensure_connection()
-        cursor = self.conn.cursor()
         try:
-            cursor.execute('''
-                INSERT INTO water_changes 
-                (start_timestamp, end_timestamp, volume_litres, 
-                 temp_before, temp_after, ph_before, ph_after, 
-                 tds_before, tds_after, duration_minutes, completed)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ''', (
-                wc_data.get('startTime'),
-                wc_data.get('endTime'),
-                wc_data.get('volume'),
-                wc_data.get('tempBefore'),
-                wc_data.get('tempAfter'),
-                wc_data.get('phBefore'),
-                wc_data.get('phAfter'),
-                wc_data.get('tdsBefore'),
-                wc_data.get('tdsAfter'),
-                wc_data.get('duration'),
-                1 if wc_data.get('successful', True) else 0
-            ))
-            self.conn.commit()
-            logger.info(f"Water change stored: {wc_data.get('volume')}L")
+            self._execute_write(self.WATER_CHANGE_INSERT_SQL, self._water_change_params(wc_data))
+            self._autocommit()
+            logger.info("Water change stored: %sL", wc_data.get('volume'))
+        except mysql.connector.Error as e:
+            logger.error("Error storing water change: %s", e)
+            if self._in_transaction:
+                raise
+    
+    def store_water_changes_bulk(self, wc_list: List[Dict]) -> int:
+        """Store many water change events with one executemany and a single commit
+        
+        Returns the number of rows inserted.
+        """
+        if not wc_list:
+            return 0
+        
+        try:
+            inserted = self._executemany(self.WATER_CHANGE_INSERT_SQL,
+                                         [self._water_change_params(wc) for wc in wc_list])
+            self._autocommit()
+            logger.info("Stored %s water changes", inserted)
+            return inserted
         except mysql.connector.Error as e:
-            logger.error(f"Error storing water change: {e}")
+            logger.error("Error storing water changes: %s", e)
+            if self._in_transaction:
+                raise
+            return 0
     
-    def get_water_change_history(self, limit: int = 50) -> List[Dict]:
-        """Get recent water change history"""
+    def get_water_change_end_timestamps(self, start: int, end: int) -> set:
+        """End timestamps already stored between start and end (inclusive)"""
         self.ensure_connection()
         cursor = self.conn.cursor()
         cursor.execute('''
-            SELECT * FROM water_changes 
+            SELECT end_timestamp FROM water_changes 
+            WHERE end_timestamp BETWEEN %s AND %s
+        ''', (start, end))
+        return {row[0] for row in cursor.fetchall()}
+    
+    # Explicit projection: id and the always-1 completed flag are not fetched
+    WATER_CHANGE_HISTORY_SQL = '''
+        SELECT start_timestamp, end_timestamp, volume_litres,
+               temp_before, temp_after, ph_before, ph_after,
+               tds_before, tds_after, duration_minutes
+        FROM water_changes 
+        WHERE completed = 1
+        ORDER BY end_timestamp DESC 
+        LIMIT %s
+    '''
+    
+    # Feature columns only, for the columnar fetch; a missing tds_after
+    # defaults to 200 ppm as it always has in feature extraction. The latest
+    # N changes come back oldest first, the order consecutive-change features
+    # are computed in; the outer sort only touches those N rows.
+    WATER_CHANGE_COLUMNS = ('end_timestamp', 'tds_before', 'tds_after', 'volume_litres')
+    WATER_CHANGE_COLUMNS_SQL = '''
+        SELECT * FROM (
+            SELECT end_timestamp, tds_before, COALESCE(tds_after, 200.0), volume_litres
+            FROM water_changes 
             WHERE completed = 1
             ORDER BY end_timestamp DESC 
             LIMIT %s
-        ''', (limit,))
+        ) AS latest
+        ORDER BY end_timestamp ASC
+    '''
+    
+    def get_water_change_history(self, limit: int = 50, columnar: bool = False):
+        """Get the most recent water changes
+        
+        Returns a list of row dicts, newest first, or with columnar=True a dict
+        mapping each of WATER_CHANGE_COLUMNS to a float64 array (NULL -> NaN)
+        in chronological order, built in one np.array() call from the fetched
+        tuples. Training and prediction use the columnar form; the row dicts
+        are kept for callers that want whole records.
+        """
+        sql = self.WATER_CHANGE_COLUMNS_SQL if columnar else self.WATER_CHANGE_HISTORY_SQL
+        self.ensure_connection()
+        cursor = self._prepared_cursor(sql)
+        cursor.execute(sql, (limit,))
+        
+        if columnar:
+            data = np.array(cursor.fetchall(), dtype=np.float64).reshape(-1, len(self.WATER_CHANGE_COLUMNS))
+            return {name: data[:, i] for i, name in enumerate(self.WATER_CHANGE_COLUMNS)}
         
         columns = [desc[0] for desc in cursor.description]
         return [dict(zip(columns, row)) for row in cursor.fetchall()]
     
+    FILTER_MAINTENANCE_INSERT_SQL = '''
+        INSERT INTO filter_maintenance 
+        (timestamp, filter_type, days_since_last, tds_before, tds_after, notes)
+        VALUES (%s, %s, %s, %s, %s, %s)
+    '''
+    
+    @staticmethod
+    def _filter_maintenance_params(fm_data: Dict) -> Tuple:
+        """Map a filter maintenance payload onto the filter_maintenance columns"""
+        return (
+            fm_data.get('timestamp', int(time.time())),
+            fm_data.get('filter_type', 'mechanical'),
+            fm_data.get('days_since_last', 0),
+            fm_data.get('tds_before'),
+            fm_data.get('tds_after'),
+            fm_data.get('notes', '')
+        )
+    
     def store_filter_maintenance(self, fm_data: Dict):
         """Store filter maintenance event"""
-        self.ensure_connection()
-        cursor = self.conn.cursor()
         try:
-            cursor.execute('''
-                INSERT INTO filter_maintenance 
-                (timestamp, filter_type, days_since_last, tds_before, tds_after, notes)
-                VALUES (%s, %s, %s, %s, %s, %s)
-            ''', (
-                fm_data.get('timestamp', int(time.time())),
-                fm_data.get('filter_type', 'mechanical'),
-                fm_data.get('days_since_last', 0),
-                fm_data.get('tds_before'),
-                fm_data.get('tds_after'),
-                fm_data.get('notes', '')
-            ))
-            self.conn.commit()
+            self._execute_write(self.FILTER_MAINTENANCE_INSERT_SQL, self._filter_maintenance_params(fm_data))
+            self._autocommit()
             logger.info("Filter maintenance recorded")
         except mysql.connector.Error as e:
-            logger.error(f"Error storing filter maintenance: {e}")
+            logger.error("Error storing filter maintenance: %s", e)
+            if self._in_transaction:
+                raise
+    
+    def store_filter_maintenance_bulk(self, fm_list: List[Dict]) -> int:
+        """Store many filter maintenance events with one executemany and a single commit
+        
+        Returns the number of rows inserted.
+        """
+        if not fm_list:
+            return 0
+        
+        try:
+            inserted = self._executemany(self.FILTER_MAINTENANCE_INSERT_SQL,
+                                         [self._filter_maintenance_params(fm) for fm in fm_list])
+            self._autocommit()
+            logger.info("Stored %s filter maintenance records", inserted)
+            return inserted
+        except mysql.connector.Error as e:
+            logger.error("Error storing filter maintenance records: %s", e)
+            if self._in_transaction:
+                raise
+            return 0
+    
+    def get_training_fingerprint(self) -> Tuple:
+        """Cheap summary of the rows water change training reads
+        
+        Changes whenever a completed water change or a filter maintenance is
+        logged, so an equal fingerprint means the history is unchanged
+        without fetching it.
+        """
+        self.ensure_connection()
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT COUNT(*), MAX(id), (SELECT MAX(id) FROM filter_maintenance)
+            FROM water_changes 
+            WHERE completed = 1
+        ''')
+        return tuple(cursor.fetchone())
+    
+    def get_pid_fingerprint(self, controller: str, season: int) -> Tuple:
+        """Cheap summary of one controller/season's PID performance rows
+        
+        pid_performance is append-only, so an equal (count, max id) means the
+        history a season model was trained on is unchanged.
+        """
+        self.ensure_connection()
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT COUNT(*), MAX(id) FROM pid_performance
+            WHERE controller = %s AND season = %s
+        ''', (controller, season))
+        return tuple(cursor.fetchone())
+    
+    def get_filter_maintenance_timestamps(self) -> np.ndarray:
+        """All filter maintenance timestamps, ascending, as an int64 array"""
+        self.ensure_connection()
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT timestamp FROM filter_maintenance ORDER BY timestamp')
+        return np.array([row[0] for row in cursor.fetchall()], dtype=np.int64)
     
     def get_last_filter_maintenance(self) -> Optional[Dict]:
         """Get the most recent filter maintenance"""
         self.ensure_connection()
         cursor = self.conn.cursor()
+        # Skip id and the free-text notes column
         cursor.execute('''
-            SELECT * FROM filter_maintenance 
+            SELECT timestamp, filter_type, days_since_last, tds_before, tds_after
+            FROM filter_maintenance 
             ORDER BY timestamp DESC 
             LIMIT 1
         ''')
@@ -461,22 +1010,42 @@ class AquariumDatabase:
     
     def store_wc_prediction(self, days: float, confidence: float, model_type: str):
         """Store water change prediction for accuracy tracking"""
-        self.ensure_connection()
-        cursor = self.conn.cursor()
+        self.store_wc_predictions_bulk([(days, confidence, model_type)])
+    
+    def store_wc_predictions_bulk(self, rows: List[Tuple[float, float, str]]) -> int:
+        """Store many (days, confidence, model_type) predictions in one round trip
+        
+        Returns the number of rows inserted.
+        """
+        if not rows:
+            return 0
+        
+        now = int(time.time())
         try:
-            cursor.execute('''
+            inserted = self._executemany('''
                 INSERT INTO wc_predictions 
                 (prediction_timestamp, predicted_days, confidence, model_type)
                 VALUES (%s, %s, %s, %s)
-            ''', (int(time.time()), days, confidence, model_type))
-            self.conn.commit()
+            ''', [(now, days, confidence, model_type) for days, confidence, model_type in rows])
+            self._autocommit()
+            return inserted
         except mysql.connector.Error as e:
-            logger.error(f"Error storing WC prediction: {e}")
+            logger.error("Error storing WC prediction: %s", e)
+            if self._in_transaction:
+                raise
+            return 0
     
     def close(self):
         """Close database connection"""
-        if self.conn and self.conn.is_connected():
-            self.conn.close()
+        if self._sensor_buffer and self.conn:
+            try:
+                self.flush_sensor_readings()
+            except mysql.connector.Error as e:
+                logger.error("Error flushing sensor readings on close: %s", e)
+        self._last_ping = 0.0
+        connected = self.conn and self.conn.is_connected()
+        self._release()
+        if connected:
             logger.info("Database connection closed")
 
 
@@ -487,18 +1056,24 @@ class AquariumDatabase:
 class PIDOptimizer:
     """ML-based PID gain optimizer with seasonal models"""
     
-    def __init__(self, db: AquariumDatabase, controller: str):
+    def __init__(self, db: AquariumDatabase, controller: str,
+                 cache_dir: Optional[str] = MODEL_CACHE_DIR):
         self.db = db
         self.controller = controller  # 'temp' or 'co2'
+        self.cache_dir = cache_dir
         self.models = {}  # season -> {kp_model, ki_model, kd_model}
-        self.scalers = {}  # season -> scaler
+        self.scores = {}  # season -> average training R² of the three models
         self.last_train_time = {}  # season -> timestamp
+        self._cache_states = {}  # season -> last fit with the fingerprint it was trained on
         
-        logger.info(f"PID Optimizer initialized for {controller} controller")
+        logger.info("PID Optimizer initialized for %s controller", controller)
     
-    def extract_features(self, history: List[Dict]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    def extract_features(self, history: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
         """Extract features and targets from performance history
         
+        History is a PID_HISTORY_DTYPE record array as returned by
+        AquariumDatabase.get_pid_performance_history().
+        
         Features:
         - Temperature (or pH for CO2 controller)
         - Ambient temperature
@@ -511,45 +1086,34 @@ class PIDOptimizer:
         Targets: Kp, Ki, Kd
         Weights: Based on performance (lower settling time & overshoot = higher weight)
         """
-        X = []
-        y_kp = []
-        y_ki = []
-        y_kd = []
-        weights = []
-        
-        for record in history:
-            # Skip records with missing data
-            if not all(k in record for k in ['kp', 'ki', 'kd', 'settling_time', 'overshoot']):
-                continue
-            
-            # Extract features
-            features = [
-                record.get('temperature', 25.0) if self.controller == 'temp' else record.get('ph', 7.0),
-                record.get('ambient_temp', 22.0),
-                record.get('tds', 300.0),
-                record.get('ph', 7.0) if self.controller == 'temp' else record.get('temperature', 25.0),
-                record.get('hour', 12),
-                datetime.fromtimestamp(record['timestamp']).weekday(),
-                record.get('tank_volume', 200.0)
-            ]
-            
-            X.append(features)
-            y_kp.append(record['kp'])
-            y_ki.append(record['ki'])
-            y_kd.append(record['kd'])
-            
-            # Calculate weight based on performance
-            # Lower settling time and overshoot = better performance = higher weight
-            settling_time = max(record['settling_time'], 1.0)  # Avoid division by zero
-            overshoot = max(record['overshoot'], 0.01)
-            weight = 1.0 / (settling_time * overshoot)
-            weights.append(weight)
-        
-        X = np.array(X)
-        y_kp = np.array(y_kp)
-        y_ki = np.array(y_ki)
-        y_kd = np.array(y_kd)
-        weights = np.array(weights)
+        # Skip records with missing performance metrics
+        history = history[~(np.isnan(history['settling_time']) | np.isnan(history['overshoot']))]
+        
+        if self.controller == 'temp':
+            primary, secondary = history['temperature'], history['ph']
+        else:
+            primary, secondary = history['ph'], history['temperature']
+        weekday = [datetime.fromtimestamp(ts).weekday() for ts in history['timestamp'].tolist()]
+        
+        # float32 is what sklearn's trees split on internally, so fitting on it
+        # skips a converted copy of X for each of the three models
+        X = np.empty((len(history), 7), dtype=np.float32)
+        X[:, 0] = primary
+        X[:, 1] = history['ambient_temp']
+        X[:, 2] = history['tds']
+        X[:, 3] = secondary
+        X[:, 4] = history['hour']
+        X[:, 5] = weekday
+        X[:, 6] = history['tank_volume']
+        y_kp = history['kp'].copy()
+        y_ki = history['ki'].copy()
+        y_kd = history['kd'].copy()
+        
+        # Calculate weight based on performance
+        # Lower settling time and overshoot = better performance = higher weight
+        settling_time = np.maximum(history['settling_time'], 1.0)  # Avoid division by zero
+        overshoot = np.maximum(history['overshoot'], 0.01)
+        weights = 1.0 / (settling_time * overshoot)
         
         # Normalize weights
         if len(weights) > 0:
@@ -559,39 +1123,44 @@ class PIDOptimizer:
     
     def train_season(self, season: int) -> Dict:
         """Train models for a specific season (0=spring, 1=summer, 2=autumn, 3=winter)"""
-        logger.info(f"Training {self.controller} controller for season {season}...")
+        logger.info("Training %s controller for season %s...", self.controller, season)
+        
+        # No new performance rows since the last fit (this run or a previous
+        # one, via the model cache): reuse it instead of refitting
+        fingerprint = self.db.get_pid_fingerprint(self.controller, season)
+        cached = self._load_unchanged_models(season, fingerprint)
+        if cached is not None:
+            return cached
         
         # Get performance history for this season
-        history = self.db.get_pid_performance_history(self.controller, season=season, limit=1000)
+        history = self.db.get_pid_performance_history(self.controller, season=season,
+                                                      limit=PID_TRAIN_HISTORY)
         
         if len(history) < MIN_PID_SAMPLES:
-            logger.warning(f"Insufficient data for {self.controller} season {season}: {len(history)} samples (need {MIN_PID_SAMPLES})")
+            logger.warning("Insufficient data for %s season %s: %s samples (need %s)", self.controller, season, len(history), MIN_PID_SAMPLES)
             return {'error': 'insufficient_data', 'samples': len(history)}
         
         # Extract features and targets
         X, y_kp, y_ki, y_kd, weights = self.extract_features(history)
         
         if len(X) == 0:
-            logger.error(f"No valid samples after feature extraction for {self.controller} season {season}")
+            logger.error("No valid samples after feature extraction for %s season %s", self.controller, season)
             return {'error': 'no_valid_samples'}
         
-        # Scale features
-        scaler = StandardScaler()
-        X_scaled = scaler.fit_transform(X)
-        
-        # Train three models (one for each PID parameter)
+        # Train three models (one for each PID parameter). Tree splits are
+        # scale-invariant, so the raw features need no StandardScaler.
         kp_model = GradientBoostingRegressor(n_estimators=50, random_state=42)
         ki_model = GradientBoostingRegressor(n_estimators=50, random_state=42)
         kd_model = GradientBoostingRegressor(n_estimators=50, random_state=42)
         
-        kp_model.fit(X_scaled, y_kp, sample_weight=weights)
-        ki_model.fit(X_scaled, y_ki, sample_weight=weights)
-        kd_model.fit(X_scaled, y_kd, sample_weight=weights)
+        kp_model.fit(X, y_kp, sample_weight=weights)
+        ki_model.fit(X, y_ki, sample_weight=weights)
+        kd_model.fit(X, y_kd, sample_weight=weights)
         
         # Calculate R² scores
-        kp_score = kp_model.score(X_scaled, y_kp, sample_weight=weights)
-        ki_score = ki_model.score(X_scaled, y_ki, sample_weight=weights)
-        kd_score = kd_model.score(X_scaled, y_kd, sample_weight=weights)
+        kp_score = kp_model.score(X, y_kp, sample_weight=weights)
+        ki_score = ki_model.score(X, y_ki, sample_weight=weights)
+        kd_score = kd_model.score(X, y_kd, sample_weight=weights)
         avg_score = (kp_score + ki_score + kd_score) / 3
         
         # Store models
@@ -600,17 +1169,17 @@ class PIDOptimizer:
             'ki': ki_model,
             'kd': kd_model
         }
-        self.scalers[season] = scaler
+        self.scores[season] = avg_score
         self.last_train_time[season] = time.time()
         
-        logger.info(f"Season {season} training complete:")
-        logger.info(f"  Samples: {len(X)}")
-        logger.info(f"  Kp R²: {kp_score:.3f}")
-        logger.info(f"  Ki R²: {ki_score:.3f}")
-        logger.info(f"  Kd R²: {kd_score:.3f}")
-        logger.info(f"  Average R²: {avg_score:.3f}")
+        logger.info("Season %s training complete:", season)
+        logger.info("  Samples: %s", len(X))
+        logger.info("  Kp R²: %.3f", kp_score)
+        logger.info("  Ki R²: %.3f", ki_score)
+        logger.info("  Kd R²: %.3f", kd_score)
+        logger.info("  Average R²: %.3f", avg_score)
         
-        return {
+        result = {
             'season': season,
             'samples': len(X),
             'kp_score': kp_score,
@@ -618,6 +1187,52 @@ class PIDOptimizer:
             'kd_score': kd_score,
             'avg_score': avg_score
         }
+        self._save_models(season, result, fingerprint)
+        
+        return result
+    
+    def _cache_path(self, season: int) -> str:
+        """Cache file for one controller/season model set"""
+        return os.path.join(self.cache_dir, f"pid_{self.controller}_season{season}.joblib")
+    
+    def _load_unchanged_models(self, season: int, fingerprint: Tuple) -> Optional[Dict]:
+        """Reuse the season's last fit, from memory or disk, if its history is unchanged"""
+        state = self._cache_states.get(season)
+        if state is None and self.cache_dir:
+            path = self._cache_path(season)
+            if os.path.exists(path):
+                try:
+                    state = joblib.load(path)
+                except Exception as e:
+                    logger.warning("Ignoring unreadable model cache %s: %s", path, e)
+        
+        if not state or state.get('version') != PID_CACHE_VERSION or \
+           state.get('fingerprint') != fingerprint:
+            return None
+        
+        self.models[season] = state['models']
+        self.scores[season] = state['result']['avg_score']
+        self.last_train_time[season] = time.time()
+        self._cache_states[season] = state
+        logger.info("No new %s performance data for season %s; reusing cached models", self.controller, season)
+        return dict(state['result'], cached=True)
+    
+    def _save_models(self, season: int, result: Dict, fingerprint: Tuple):
+        """Keep the season's fitted models in memory and on disk for the next start"""
+        self._cache_states[season] = {
+            'version': PID_CACHE_VERSION,
+            'models': self.models[season],
+            'result': result,
+            'fingerprint': fingerprint
+        }
+        if not self.cache_dir:
+            return
+        
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            joblib.dump(self._cache_states[season], self._cache_path(season), compress=3)
+        except OSError as e:
+            logger.warning("Could not write model cache: %s", e)
     
     def train_all_seasons(self) -> Dict:
         """Train models for all four seasons"""
@@ -631,34 +1246,35 @@ class PIDOptimizer:
     def predict(self, sensor_data: Dict, season: int) -> Dict:
         """Predict optimal PID gains for current conditions"""
         if season not in self.models:
-            logger.warning(f"No model available for {self.controller} season {season}")
+            logger.warning("No model available for %s season %s", self.controller, season)
             return {'error': 'no_model', 'season': season}
         
+        # One clock read so hour, weekday and timestamp agree across midnight
+        now_ts = time.time()
+        now = datetime.fromtimestamp(now_ts)
+        
         # Extract features
         features = [
             sensor_data.get('temperature', 25.0) if self.controller == 'temp' else sensor_data.get('ph', 7.0),
             sensor_data.get('ambient_temp', 22.0),
             sensor_data.get('tds', 300.0),
             sensor_data.get('ph', 7.0) if self.controller == 'temp' else sensor_data.get('temperature', 25.0),
-            datetime.now().hour,
-            datetime.now().weekday(),
+            now.hour,
+            now.weekday(),
             sensor_data.get('tank_volume', 200.0)
         ]
         
-        X = np.array([features])
-        X_scaled = self.scalers[season].transform(X)
+        X = np.array([features], dtype=np.float32)
         
         # Predict
-        kp = float(self.models[season]['kp'].predict(X_scaled)[0])
-        ki = float(self.models[season]['ki'].predict(X_scaled)[0])
-        kd = float(self.models[season]['kd'].predict(X_scaled)[0])
+        kp = float(self.models[season]['kp'].predict(X)[0])
+        ki = float(self.models[season]['ki'].predict(X)[0])
+        kd = float(self.models[season]['kd'].predict(X)[0])
         
-        # Calculate confidence (based on how similar current conditions are to training data)
-        # For simplicity, use average R² score
-        confidence = (self.models[season]['kp'].score(X_scaled, [kp]) + 
-                     self.models[season]['ki'].score(X_scaled, [ki]) + 
-                     self.models[season]['kd'].score(X_scaled, [kd])) / 3
-        confidence = max(0.0, min(1.0, confidence))  # Clamp to [0, 1]
+        # Confidence is the season's average training R². Scoring the single
+        # prediction against itself is undefined (NaN) and costs three more
+        # predict() passes.
+        confidence = max(0.0, min(1.0, self.scores[season]))  # Clamp to [0, 1]
         
         return {
             'controller': self.controller,
@@ -668,7 +1284,7 @@ class PIDOptimizer:
             'kd': kd,
             'confidence': confidence,
             'model': 'gradient_boosting',
-            'timestamp': int(time.time())
+            'timestamp': int(now_ts)
         }
 
 
@@ -676,25 +1292,86 @@ class PIDOptimizer:
 # Water Change Predictor
 # ============================================================================
 
+def water_change_features(end_ts: np.ndarray, tds_before: np.ndarray, tds_after: np.ndarray,
+                          volume_litres: np.ndarray, ambient_temp: float,
+                          fm_ts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Vectorised feature rows for each consecutive pair of water changes
+    
+    Row i pairs change i+1 with the change before it; fm_ts holds the filter
+    maintenance timestamps in ascending order. Pairs where the current
+    change lacks end_timestamp/tds_before/volume (NaN) are dropped. Inputs
+    stay float64 (epoch seconds need it); the feature matrix is float32,
+    which sensor precision allows and the tree models use internally.
+    """
+    days_between = np.diff(end_ts) / 86400.0
+    tds_increase_rate = (tds_before[1:] - tds_after[:-1]) / np.maximum(days_between, 1.0)
+    volume_percent = (volume_litres[1:] / 200.0) * 100.0  # Assuming 200L tank
+    
+    # Most recent maintenance at or before each change: one binary search per
+    # change over the sorted timestamps; 30 days when none precedes it
+    current_end = end_ts[1:]
+    prev_fm = np.searchsorted(fm_ts, current_end, side='right') - 1
+    has_fm = prev_fm >= 0
+    days_since_fm = np.full(len(current_end), 30.0)
+    days_since_fm[has_fm] = (current_end[has_fm] - fm_ts[prev_fm[has_fm]]) / 86400.0
+    
+    X = np.column_stack([
+        days_between,
+        tds_before[1:],
+        tds_increase_rate,
+        volume_percent,
+        np.full(len(days_between), ambient_temp),
+        days_since_fm
+    ])
+    valid = ~np.isnan(X).any(axis=1)
+    return X[valid].astype(np.float32), days_between[valid]
+
+
 class WaterChangePredictor:
     """ML-based water change predictor"""
     
-    def __init__(self, db: AquariumDatabase):
+    # Only the linear model is sensitive to feature scale; the tree models
+    # train and predict on raw features
+    SCALED_MODELS = frozenset({'linear'})
+    
+    def __init__(self, db: AquariumDatabase, cache_dir: Optional[str] = MODEL_CACHE_DIR):
         self.db = db
+        self.cache_dir = cache_dir
         self.models = {
             'linear': LinearRegression(),
-            'random_forest': RandomForestRegressor(n_estimators=50, random_state=42),
+            # Bins each feature once (64 bins) instead of sorting at every split;
+            # the default 20-row leaves would leave ~100 rows almost unsplit
+            'hist_gradient_boost': HistGradientBoostingRegressor(
+                max_iter=50, max_bins=64, min_samples_leaf=2, random_state=42
+            ),
             'gradient_boost': GradientBoostingRegressor(n_estimators=50, random_state=42)
         }
         self.scaler = StandardScaler()
         self.best_model_name = None
         self.best_model = None
+        self.best_score = 0.0  # training R² of best_model
+        self._champion = None  # model kept between bake-offs
+        self._challenger_idx = 0
+        self._fits_since_bakeoff = 0
         self.last_train_time = 0
+        self._cache_state = None  # last fit with the fingerprint it was trained on
+        self.samples_at_last_train = 0
+        self.new_events = 0  # water changes / maintenance logged since the last train()
+        # Bumped by the MQTT writer while train() runs on the service thread
+        self._new_events_lock = threading.Lock()
         
         logger.info("Water Change Predictor initialized")
     
-    def extract_features(self, history: List[Dict]) -> Tuple[np.ndarray, np.ndarray]:
-        """Extract features from water change history
+    def _ambient_temp(self) -> float:
+        """Ambient temperature averaged over the last 24h (default 22.0)"""
+        ambient_temp = self.db.get_sensor_averages(hours=24)['ambient_temp']
+        return ambient_temp if ambient_temp is not None else 22.0
+    
+    def extract_features(self, history: Dict[str, np.ndarray],
+                         ambient_temp: Optional[float] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Extract features from columnar water change history
+        
+        history is get_water_change_history(columnar=True) output, oldest first.
         
         Features:
         - Days since previous water change
@@ -706,98 +1383,235 @@ class WaterChangePredictor:
         
         Target: Days between water changes
         """
-        X = []
-        y = []
-        
-        # Get last filter maintenance
-        last_fm = self.db.get_last_filter_maintenance()
-        last_fm_ts = last_fm['timestamp'] if last_fm else 0
-        
-        for i in range(1, len(history)):
-            current = history[i]
-            previous = history[i - 1]
-            
-            # Skip if missing data
-            if not all(k in current for k in ['end_timestamp', 'tds_before', 'volume_litres']):
-                continue
-            
-            days_between = (current['end_timestamp'] - previous['end_timestamp']) / 86400.0
-            tds_before = current.get('tds_before', 300.0)
-            tds_after_prev = previous.get('tds_after', 200.0)
-            tds_increase_rate = (tds_before - tds_after_prev) / max(days_between, 1.0)
-            volume_percent = (current['volume_litres'] / 200.0) * 100.0  # Assuming 200L tank
-            
-            # Get ambient temp from sensor readings around that time
-            ambient_temp = 22.0  # Default
-            sensor_readings = self.db.get_recent_sensor_readings(hours=24)
-            if sensor_readings:
-                temps = [r.get('ambient_temp', 22.0) for r in sensor_readings if r.get('ambient_temp')]
-                if temps:
-                    ambient_temp = np.mean(temps)
-            
-            # Days since last filter maintenance
-            days_since_fm = (current['end_timestamp'] - last_fm_ts) / 86400.0 if last_fm_ts > 0 else 30.0
-            
-            features = [
-                days_between,
-                tds_before,
-                tds_increase_rate,
-                volume_percent,
-                ambient_temp,
-                days_since_fm
-            ]
-            
-            X.append(features)
-            y.append(days_between)
+        # Every filter maintenance, so each change is paired with the one before it
+        fm_ts = self.db.get_filter_maintenance_timestamps()
+        
+        # Ambient temp averaged over the last 24h. The window does not depend on
+        # the row, so query it once rather than once per water change.
+        if ambient_temp is None:
+            ambient_temp = self._ambient_temp()
+        
+        if len(history['end_timestamp']) < 2:
+            return np.empty((0, 6), dtype=np.float32), np.empty(0)
+        
+        return water_change_features(
+            history['end_timestamp'],
+            history['tds_before'],
+            history['tds_after'],
+            history['volume_litres'],
+            ambient_temp,
+            fm_ts
+        )
+    
+    def note_new_events(self, count: int = 1):
+        """Record water change or filter maintenance events logged since training"""
+        with self._new_events_lock:
+            self.new_events += count
+        if self.enough_new_data():
+            service_wakeup.set()
+    
+    def enough_new_data(self) -> bool:
+        """Whether enough events arrived to justify retraining before the schedule
         
-        return np.array(X), np.array(y)
+        True once new events reach WC_RETRAIN_FRACTION of the samples the
+        current model was fitted on (any event, if nothing is fitted yet).
+        """
+        return self.new_events >= max(1, WC_RETRAIN_FRACTION * self.samples_at_last_train)
     
     def train(self) -> Dict:
         """Train water change prediction models"""
         logger.info("Training water change prediction models...")
+        # Reset before the data is read: an event logged mid-train may then be
+        # counted again next time, but is never missed
+        with self._new_events_lock:
+            self.new_events = 0
+        
+        # No new water changes or filter maintenance since the cached fit and
+        # ambient temperature has barely moved: skip the fetch and the refit
+        fingerprint = self.db.get_training_fingerprint()
+        ambient_temp = self._ambient_temp()
+        cached = self._load_unchanged_model(fingerprint, ambient_temp)
+        if cached is not None:
+            return cached
         
         # Get water change history
-        history = self.db.get_water_change_history(limit=100)
+        history = self.db.get_water_change_history(limit=WC_TRAIN_HISTORY, columnar=True)
+        samples = len(history['end_timestamp'])
         
-        if len(history) < MIN_WC_SAMPLES:
-            logger.warning(f"Insufficient water change history: {len(history)} records (need {MIN_WC_SAMPLES})")
-            return {'error': 'insufficient_data', 'samples': len(history)}
+        if samples < MIN_WC_SAMPLES:
+            logger.warning("Insufficient water change history: %s records (need %s)", samples, MIN_WC_SAMPLES)
+            return {'error': 'insufficient_data', 'samples': samples}
         
         # Extract features
-        X, y = self.extract_features(history)
+        X, y = self.extract_features(history, ambient_temp)
         
         if len(X) < MIN_WC_SAMPLES:
-            logger.warning(f"Insufficient valid samples after feature extraction: {len(X)}")
+            logger.warning("Insufficient valid samples after feature extraction: %s", len(X))
             return {'error': 'insufficient_samples', 'samples': len(X)}
         
-        # Scale features
-        X_scaled = self.scaler.fit_transform(X)
+        # Identical training data gives identical models, so reuse the last fit
+        cache_key = hashlib.blake2b(X.tobytes() + y.tobytes(), digest_size=16).hexdigest()
+        cached = self._load_cached_model(cache_key)
+        if cached is not None:
+            return cached
+        
+        # Scale features only if a model that needs it is fitted this round
+        candidates = self._candidates()
+        if self.SCALED_MODELS.intersection(candidates):
+            X_scaled = self.scaler.fit_transform(X)
         
-        # Train all models and find best
+        # Train the candidates for this round and find best
         scores = {}
-        for name, model in self.models.items():
-            model.fit(X_scaled, y)
-            score = model.score(X_scaled, y)
+        for name in candidates:
+            model = self.models[name]
+            X_fit = X_scaled if name in self.SCALED_MODELS else X
+            model.fit(X_fit, y)
+            score = model.score(X_fit, y)
             scores[name] = score
-            logger.debug(f"  {name}: R² = {score:.3f}")
+            logger.debug("  %s: R² = %.3f", name, score)
         
         # Select best model
-        self.best_model_name = max(scores, key=scores.get)
+        self.best_model_name = self._select_champion(scores)
         self.best_model = self.models[self.best_model_name]
         best_score = scores[self.best_model_name]
+        self.best_score = best_score
         self.last_train_time = time.time()
+        self.samples_at_last_train = len(X)
         
-        logger.info(f"Training complete:")
-        logger.info(f"  Best model: {self.best_model_name}")
-        logger.info(f"  R² score: {best_score:.3f}")
-        logger.info(f"  Training samples: {len(X)}")
+        logger.info("Training complete:")
+        logger.info("  Best model: %s", self.best_model_name)
+        logger.info("  R² score: %.3f", best_score)
+        logger.info("  Training samples: %s", len(X))
         
-        return {
+        result = {
             'model': self.best_model_name,
             'score': best_score,
             'training_samples': len(X),
             'all_scores': scores
         }
+        self._save_cached_model(cache_key, result, fingerprint, ambient_temp)
+        
+        return result
+    
+    def _candidates(self) -> List[str]:
+        """Models to fit this round: all of them, or the champion and one challenger
+        
+        A full bake-off runs on the first fit and every WC_BAKEOFF_EVERY fits;
+        in between the remaining models take turns as the challenger.
+        """
+        if self._champion is None or self._fits_since_bakeoff >= WC_BAKEOFF_EVERY:
+            self._fits_since_bakeoff = 0
+            return list(self.models)
+        
+        self._fits_since_bakeoff += 1
+        others = [name for name in self.models if name != self._champion]
+        challenger = others[self._challenger_idx % len(others)]
+        self._challenger_idx += 1
+        return [self._champion, challenger]
+    
+    def _select_champion(self, scores: Dict[str, float]) -> str:
+        """Pick the best scoring model; a challenger must beat the champion by a margin"""
+        best = max(scores, key=scores.get)
+        if self._champion in scores and len(scores) < len(self.models) and \
+           scores[best] < scores[self._champion] + WC_PROMOTE_MARGIN:
+            best = self._champion
+        self._champion = best
+        return best
+    
+    def _cache_path(self, cache_key: str) -> str:
+        """Cache file for one training data fingerprint"""
+        return os.path.join(self.cache_dir, f"wc_model_{cache_key}.joblib")
+    
+    def _read_cache(self, path: str) -> Optional[Dict]:
+        """Load one cached model state, ignoring unreadable files"""
+        try:
+            state = joblib.load(path)
+        except Exception as e:
+            logger.warning("Ignoring unreadable model cache %s: %s", path, e)
+            return None
+        
+        # Tree models cached before SCALED_MODELS were fitted on scaled features
+        if state.get('version') != WC_CACHE_VERSION:
+            logger.info("Ignoring model cache %s from an older version", path)
+            return None
+        return state
+    
+    def _restore(self, state: Dict) -> Dict:
+        """Adopt a cached model state and return its training result"""
+        self.scaler = state['scaler']
+        self.best_model_name = state['result']['model']
+        self.best_model = state['best_model']
+        self.best_score = state['result']['score']
+        self.models[self.best_model_name] = self.best_model
+        self._champion = self.best_model_name
+        self.last_train_time = time.time()
+        self.samples_at_last_train = state['result']['training_samples']
+        self._cache_state = state
+        return dict(state['result'], cached=True)
+    
+    def _load_unchanged_model(self, fingerprint: Tuple, ambient_temp: float) -> Optional[Dict]:
+        """Reuse the last fit if its history fingerprint still matches
+        
+        Checks the in-memory state first, then the single model kept in the
+        cache directory, so --once runs benefit as well as the service.
+        """
+        state = self._cache_state
+        if state is None and self.cache_dir and os.path.isdir(self.cache_dir):
+            for name in os.listdir(self.cache_dir):
+                if name.startswith('wc_model_'):
+                    state = self._read_cache(os.path.join(self.cache_dir, name))
+                    break
+        
+        if not state or state.get('fingerprint') != fingerprint:
+            return None
+        if abs(state['ambient_temp'] - ambient_temp) > WC_AMBIENT_TOLERANCE:
+            return None
+        
+        result = self._restore(state)
+        logger.info("No new water changes since last training; reusing %s model", self.best_model_name)
+        return result
+    
+    def _load_cached_model(self, cache_key: str) -> Optional[Dict]:
+        """Restore the fitted model for this training data from disk, if cached"""
+        if not self.cache_dir:
+            return None
+        
+        path = self._cache_path(cache_key)
+        if not os.path.exists(path):
+            return None
+        
+        state = self._read_cache(path)
+        if state is None:
+            return None
+        
+        result = self._restore(state)
+        logger.info("Training data unchanged; loaded cached %s model", self.best_model_name)
+        return result
+    
+    def _save_cached_model(self, cache_key: str, result: Dict, fingerprint: Tuple,
+                           ambient_temp: float):
+        """Keep the fitted model in memory and on disk, dropping caches for older data"""
+        self._cache_state = {
+            'version': WC_CACHE_VERSION,
+            'scaler': self.scaler,
+            'best_model': self.best_model,
+            'result': result,
+            'fingerprint': fingerprint,
+            'ambient_temp': ambient_temp
+        }
+        if not self.cache_dir:
+            return
+        
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = self._cache_path(cache_key)
+            joblib.dump(self._cache_state, path, compress=3)
+            for name in os.listdir(self.cache_dir):
+                stale = os.path.join(self.cache_dir, name)
+                if name.startswith('wc_model_') and stale != path:
+                    os.remove(stale)
+        except OSError as e:
+            logger.warning("Could not write model cache: %s", e)
     
     def predict(self) -> Dict:
         """Predict next water change"""
@@ -806,40 +1620,33 @@ class WaterChangePredictor:
             return {'error': 'no_model'}
         
         # Get recent data
-        history = self.db.get_water_change_history(limit=10)
-        sensor_readings = self.db.get_recent_sensor_readings(hours=24)
+        history = self.db.get_water_change_history(limit=10, columnar=True)
+        averages = self.db.get_sensor_averages(hours=24)
         
-        if len(history) < 1:
+        if len(history['end_timestamp']) < 1:
             return {'error': 'no_history'}
         
-        last_wc = history[0]
-        days_since_last = (time.time() - last_wc['end_timestamp']) / 86400.0
+        now_ts = time.time()
+        days_since_last = (now_ts - history['end_timestamp'][-1]) / 86400.0
         
         # Get current TDS
-        current_tds = 300.0
-        if sensor_readings:
-            tds_values = [r.get('tds', 300.0) for r in sensor_readings if r.get('tds')]
-            if tds_values:
-                current_tds = np.mean(tds_values)
+        current_tds = averages['tds'] if averages['tds'] is not None else 300.0
         
         # Calculate TDS increase rate
-        tds_after_last = last_wc.get('tds_after', 200.0)
+        tds_after_last = history['tds_after'][-1]
         tds_increase_rate = (current_tds - tds_after_last) / max(days_since_last, 1.0)
         
         # Get ambient temp
-        ambient_temp = 22.0
-        if sensor_readings:
-            temps = [r.get('ambient_temp', 22.0) for r in sensor_readings if r.get('ambient_temp')]
-            if temps:
-                ambient_temp = np.mean(temps)
+        ambient_temp = averages['ambient_temp'] if averages['ambient_temp'] is not None else 22.0
         
         # Days since last filter maintenance
         last_fm = self.db.get_last_filter_maintenance()
-        days_since_fm = (time.time() - last_fm['timestamp']) / 86400.0 if last_fm else 30.0
+        days_since_fm = (now_ts - last_fm['timestamp']) / 86400.0 if last_fm else 30.0
         
         # Average volume from history
-        volumes = [wc.get('volume_litres', 40.0) for wc in history if wc.get('volume_litres')]
-        avg_volume_percent = (np.mean(volumes) / 200.0) * 100.0 if volumes else 20.0
+        volumes = history['volume_litres']
+        volumes = volumes[~np.isnan(volumes) & (volumes != 0)]
+        avg_volume_percent = (volumes.mean() / 200.0) * 100.0 if len(volumes) else 20.0
         
         # Predict
         features = np.array([[
@@ -849,14 +1656,18 @@ class WaterChangePredictor:
             avg_volume_percent,
             ambient_temp,
             days_since_fm
-        ]])
+        ]], dtype=np.float32)
         
-        X_scaled = self.scaler.transform(features)
-        predicted_total_days = float(self.best_model.predict(X_scaled)[0])
+        if self.best_model_name in self.SCALED_MODELS:
+            features = self.scaler.transform(features)
+        predicted_total_days = float(self.best_model.predict(features)[0])
         predicted_days_remaining = max(0, predicted_total_days - days_since_last)
         
-        # Calculate confidence
-        confidence = min(0.95, self.best_model.score(X_scaled, [predicted_total_days]))
+        # Confidence from the fit recorded at training time, discounted while
+        # fewer than 20 water changes back it; scoring the single prediction
+        # against itself is undefined (NaN)
+        data_confidence = min(1.0, self.samples_at_last_train / 20.0)
+        confidence = min(0.95, max(0.0, self.best_score) * data_confidence)
         confidence = max(CONFIDENCE_THRESHOLD, confidence)
         
         needs_change_soon = predicted_days_remaining < 3.0
@@ -870,7 +1681,7 @@ class WaterChangePredictor:
             'confidence': round(confidence, 2),
             'model': self.best_model_name,
             'needs_change_soon': needs_change_soon,
-            'timestamp': int(time.time())
+            'timestamp': int(now_ts)
         }
 
 
@@ -878,6 +1689,34 @@ class WaterChangePredictor:
 # MQTT Manager
 # ============================================================================
 
+def _json_default(obj):
+    """Convert NumPy scalars for the stdlib json fallback"""
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps_payload(obj) -> bytes:
+    """Serialise an MQTT payload to compact UTF-8 JSON bytes
+    
+    Top-level None values are dropped rather than sent as null; the firmware
+    reads every field with a default. The stdlib fallback uses the same
+    whitespace-free separators orjson emits.
+    """
+    if isinstance(obj, dict):
+        obj = {key: value for key, value in obj.items() if value is not None}
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, separators=(',', ':'), default=_json_default).encode()
+
+
+def loads_payload(data: bytes):
+    """Parse an MQTT JSON payload (raises json.JSONDecodeError on bad input)"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
 class MQTTManager:
     """Unified MQTT client for all ML operations"""
     
@@ -886,7 +1725,7 @@ class MQTTManager:
         self.db = db
         self.pid_optimizers = pid_optimizers
         self.wc_predictor = wc_predictor
-        self.client = mqtt.Client()
+        self.client = mqtt.Client(protocol=mqtt.MQTTv5)
         
         if MQTT_USER and MQTT_PASSWORD:
             self.client.username_pw_set(MQTT_USER, MQTT_PASSWORD)
@@ -895,51 +1734,114 @@ class MQTTManager:
         self.client.on_message = self.on_message
         self.client.on_disconnect = self.on_disconnect
         
+        # The broker publishes this if the service drops off without a DISCONNECT
+        self.client.will_set(TOPIC_ML_STATUS, dumps_payload({'state': 'offline'}), retain=True)
+        
         self.connected = False
+        self._connect_pending = False
+        
+        # Messages are decoded on paho's network thread and stored here, so a
+        # slow insert never stalls reading the socket. One worker keeps writes
+        # in arrival order. mysql-connector connections are not thread-safe,
+        # so db must be used only by this worker: the service passes a
+        # separate AquariumDatabase on its own pooled connection.
+        self._db_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='mqtt-db')
     
-    def connect(self):
-        """Connect to MQTT broker"""
+    def connect(self, background: bool = False):
+        """Connect to MQTT broker
+        
+        With background=True the TCP/CONNACK handshake runs on the network
+        thread so the caller can carry on with DB and training work; the
+        first publish waits for it to finish.
+        """
         try:
-            self.client.connect(MQTT_BROKER, MQTT_PORT, 60)
+            if background:
+                self.client.connect_async(MQTT_BROKER, MQTT_PORT, MQTT_KEEPALIVE)
+                self._connect_pending = True
+            else:
+                self.client.connect(MQTT_BROKER, MQTT_PORT, MQTT_KEEPALIVE)
             self.client.loop_start()
-            logger.info(f"MQTT connecting to {MQTT_BROKER}:{MQTT_PORT}")
+            logger.info("MQTT connecting to %s:%s", MQTT_BROKER, MQTT_PORT)
         except Exception as e:
-            logger.error(f"MQTT connection error: {e}")
+            logger.error("MQTT connection error: %s", e)
             raise
     
+    def wait_for_connection(self, timeout: float = 10) -> bool:
+        """Block until the broker has acknowledged the connection or timeout expires"""
+        deadline = time.time() + timeout
+        while not self.connected and time.time() < deadline:
+            time.sleep(0.1)
+        return self.connected
+    
+    def _await_pending_connect(self):
+        """Finish a background connect before the first publish"""
+        if self._connect_pending:
+            self._connect_pending = False
+            if not self.wait_for_connection():
+                logger.warning("MQTT not connected; predictions will not be published")
+    
     def disconnect(self):
         """Disconnect from MQTT broker"""
-        self.client.loop_stop()
+        # DISCONNECT is queued behind any pending publishes, so stopping the
+        # network loop afterwards lets retained predictions reach the broker.
+        # A clean disconnect suppresses the will, so report offline here.
+        self.client.publish(TOPIC_ML_STATUS, dumps_payload({'state': 'offline'}), retain=True)
         self.client.disconnect()
+        self.client.loop_stop()
+        # Let queued messages reach the database before it is closed
+        self._db_writer.shutdown(wait=True)
         logger.info("MQTT disconnected")
     
-    def on_connect(self, client, userdata, flags, rc):
+    def on_connect(self, client, userdata, flags, rc, properties=None):
         """Callback when connected to MQTT broker"""
         if rc == 0:
             self.connected = True
             logger.info("MQTT connected successfully")
             
             # Subscribe to topics
-            client.subscribe(TOPIC_SENSOR_DATA)
-            client.subscribe(TOPIC_PID_PERFORMANCE)
-            client.subscribe(TOPIC_WC_EVENT)
-            client.subscribe(TOPIC_FILTER_MAINTENANCE)
+            client.subscribe(MQTT_SUBSCRIPTIONS)
+            client.publish(TOPIC_ML_STATUS, dumps_payload({'state': 'online'}), retain=True)
             
-            logger.info(f"Subscribed to: {TOPIC_SENSOR_DATA}, {TOPIC_PID_PERFORMANCE}, {TOPIC_WC_EVENT}, {TOPIC_FILTER_MAINTENANCE}")
+            logger.info("Subscribed to: %s", ', '.join(topic for topic, _ in MQTT_SUBSCRIPTIONS))
         else:
-            logger.error(f"MQTT connection failed with code {rc}")
+            logger.error("MQTT connection failed with code %s", rc)
     
-    def on_disconnect(self, client, userdata, rc):
+    def on_disconnect(self, client, userdata, rc, properties=None):
         """Callback when disconnected from MQTT broker"""
         self.connected = False
-        logger.warning(f"MQTT disconnected with code {rc}")
+        logger.warning("MQTT disconnected with code %s", rc)
     
     def on_message(self, client, userdata, msg):
-        """Callback when message received"""
+        """Callback when message received: decode, then queue the DB write"""
+        # Nothing may escape: an exception here would kill paho's network thread
+        try:
+            payload = loads_payload(msg.payload)
+        except ValueError as e:  # JSONDecodeError, invalid UTF-8, orjson errors
+            logger.error("JSON decode error: %s", e)
+            return
+        
+        try:
+            self._db_writer.submit(self.handle_message, msg.topic, payload)
+        except Exception as e:  # RuntimeError once the writer has shut down
+            logger.error("Error queueing message: %s", e)
+    
+    def drain(self):
+        """Block until every message queued so far has been handled"""
+        self._db_writer.submit(lambda: None).result()
+    
+    def flush_sensor_readings(self, wait: bool = False):
+        """Flush buffered sensor readings on the writer thread that fills the buffer
+        
+        With wait=True this blocks until they are stored, so a query on another
+        connection that follows sees them.
+        """
+        future = self._db_writer.submit(self.db.flush_sensor_readings)
+        if wait:
+            future.result()
+    
+    def handle_message(self, topic: str, payload):
+        """Store one decoded message (runs on the DB writer thread)"""
         try:
-            payload = json.loads(msg.payload.decode())
-            topic = msg.topic
-            
             # Handle sensor data
             if topic == TOPIC_SENSOR_DATA:
                 self.db.store_sensor_reading(payload)
@@ -947,51 +1849,77 @@ class MQTTManager:
             # Handle PID performance data
             elif topic == TOPIC_PID_PERFORMANCE:
                 self.db.store_pid_performance(payload)
-                logger.debug(f"Stored PID performance for {payload.get('controller', 'unknown')}")
+                logger.debug("Stored PID performance for %s", payload.get('controller', 'unknown'))
             
             # Handle water change events
             elif topic == TOPIC_WC_EVENT:
                 self.db.store_water_change(payload)
+                self.wc_predictor.note_new_events()
                 logger.info("Water change event recorded")
             
+            # Handle water change history (list of events, e.g. on bootstrap)
+            elif topic == TOPIC_WC_HISTORY:
+                self.store_wc_history(payload)
+            
             # Handle filter maintenance
             elif topic == TOPIC_FILTER_MAINTENANCE:
                 self.db.store_filter_maintenance(payload)
+                self.wc_predictor.note_new_events()
                 logger.info("Filter maintenance recorded")
             
-        except json.JSONDecodeError as e:
-            logger.error(f"JSON decode error: {e}")
         except Exception as e:
-            logger.error(f"Error processing message: {e}")
+            logger.error("Error processing message: %s", e)
+    
+    def store_wc_history(self, history: List[Dict]):
+        """Bulk-store a water change history list, skipping events already recorded
+        
+        Replaying the history would otherwise duplicate rows, so end
+        timestamps already in the table are fetched with one indexed query
+        and the remaining events go in with a single executemany.
+        """
+        end_times = [wc['endTime'] for wc in history if wc.get('endTime')]
+        if not end_times:
+            return
+        
+        known = self.db.get_water_change_end_timestamps(min(end_times), max(end_times))
+        new = [wc for wc in history if wc.get('endTime') and wc['endTime'] not in known]
+        inserted = self.db.store_water_changes_bulk(new)
+        self.wc_predictor.note_new_events(inserted)
+        logger.info("Water change history received: %s new of %s", inserted, len(history))
     
     def publish_pid_gains(self, gains: Dict):
         """Publish optimized PID gains"""
+        self._await_pending_connect()
         try:
-            payload = json.dumps(gains)
+            payload = dumps_payload(gains)
             result = self.client.publish(TOPIC_PID_GAINS, payload, retain=True)
             if result.rc == mqtt.MQTT_ERR_SUCCESS:
-                logger.info(f"Published {gains['controller']} PID gains: Kp={gains['kp']:.3f}, Ki={gains['ki']:.3f}, Kd={gains['kd']:.3f}")
+                logger.info("Published %s PID gains: Kp=%.3f, Ki=%.3f, Kd=%.3f", gains['controller'], gains['kp'], gains['ki'], gains['kd'])
                 return True
             else:
-                logger.error(f"Failed to publish PID gains, return code: {result.rc}")
+                logger.error("Failed to publish PID gains, return code: %s", result.rc)
                 return False
         except Exception as e:
-            logger.error(f"Error publishing PID gains: {e}")
+            logger.error("Error publishing PID gains: %s", e)
             return False
     
     def publish_wc_prediction(self, prediction: Dict):
         """Publish water change prediction"""
+        self._await_pending_connect()
         try:
-            payload = json.dumps(prediction)
-            result = self.client.publish(TOPIC_WC_PREDICTION, payload, retain=True)
+            payload = dumps_payload(prediction)
+            properties = Properties(PacketTypes.PUBLISH)
+            properties.MessageExpiryInterval = WC_PREDICTION_EXPIRY
+            result = self.client.publish(TOPIC_WC_PREDICTION, payload, retain=True,
+                                         properties=properties)
             if result.rc == mqtt.MQTT_ERR_SUCCESS:
-                logger.info(f"Published WC prediction: {prediction['predicted_days_remaining']} days remaining")
+                logger.info("Published WC prediction: %s days remaining", prediction['predicted_days_remaining'])
                 return True
             else:
-                logger.error(f"Failed to publish WC prediction, return code: {result.rc}")
+                logger.error("Failed to publish WC prediction, return code: %s", result.rc)
                 return False
         except Exception as e:
-            logger.error(f"Error publishing WC prediction: {e}")
+            logger.error("Error publishing WC prediction: %s", e)
             return False
 
 
@@ -1002,20 +1930,24 @@ class MQTTManager:
 class AquariumMLService:
     """Unified ML service for aquarium automation"""
     
-    def __init__(self):
+    def __init__(self, cache_dir: Optional[str] = MODEL_CACHE_DIR):
         self.db = AquariumDatabase(DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD)
-        self.pid_temp = PIDOptimizer(self.db, 'temp')
-        self.pid_co2 = PIDOptimizer(self.db, 'co2')
-        self.wc_predictor = WaterChangePredictor(self.db)
-        self.mqtt = MQTTManager(self.db, {'temp': self.pid_temp, 'co2': self.pid_co2}, self.wc_predictor)
+        self.pid_temp = PIDOptimizer(self.db, 'temp', cache_dir=cache_dir)
+        self.pid_co2 = PIDOptimizer(self.db, 'co2', cache_dir=cache_dir)
+        self.wc_predictor = WaterChangePredictor(self.db, cache_dir=cache_dir)
+        # The MQTT writer thread stores messages on its own connection; training
+        # and prediction on this thread keep self.db
+        self.mqtt_db = AquariumDatabase(DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD,
+                                        create_tables=False)
+        self.mqtt = MQTTManager(self.mqtt_db, {'temp': self.pid_temp, 'co2': self.pid_co2}, self.wc_predictor)
         
         self.last_pid_train = {}
         self.last_wc_train = 0
         
         logger.info("=" * 60)
         logger.info("Aquarium ML Service Initialized")
-        logger.info(f"Database: {DB_HOST}:{DB_PORT}/{DB_NAME}")
-        logger.info(f"MQTT: {MQTT_BROKER}:{MQTT_PORT}")
+        logger.info("Database: %s:%s/%s", DB_HOST, DB_PORT, DB_NAME)
+        logger.info("MQTT: %s:%s", MQTT_BROKER, MQTT_PORT)
         logger.info("=" * 60)
     
     def train_all_pid_models(self):
@@ -1041,18 +1973,24 @@ class AquariumMLService:
     def train_wc_model(self):
         """Train water change prediction model"""
         logger.info("\n--- Water Change Predictor ---")
+        # Ambient temperature averages read the latest buffered readings
+        self.mqtt.flush_sensor_readings(wait=True)
         result = self.wc_predictor.train()
         
         if 'error' not in result:
             # Generate and publish prediction
             prediction = self.wc_predictor.predict()
             if 'error' not in prediction:
-                self.mqtt.publish_wc_prediction(prediction)
+                # Stored (and committed) on its own, not rolled back on a failed
+                # publish: at QoS 0 success only means the message was queued
+                # locally, so a commit gated on it vouches for nothing
                 self.db.store_wc_prediction(
                     prediction['predicted_days_remaining'],
                     prediction['confidence'],
                     prediction['model']
                 )
+                if not self.mqtt.publish_wc_prediction(prediction):
+                    logger.warning("WC prediction stored but not published")
         
         self.last_wc_train = time.time()
         
@@ -1060,20 +1998,20 @@ class AquariumMLService:
     
     def publish_pid_predictions(self, season: int):
         """Generate and publish PID predictions for current conditions"""
-        # Get recent sensor data
-        sensor_readings = self.db.get_recent_sensor_readings(hours=1)
-        if not sensor_readings:
+        # Average the last hour of sensor data on the server, including
+        # readings still buffered on the MQTT writer
+        self.mqtt.flush_sensor_readings(wait=True)
+        averages = self.db.get_sensor_averages(hours=1)
+        if not averages['count']:
             logger.warning("No recent sensor data for PID prediction")
             return
         
-        # Average recent readings
+        defaults = {'temperature': 25.0, 'ambient_temp': 22.0, 'tds': 300.0, 'ph': 7.0}
         sensor_data = {
-            'temperature': np.mean([r.get('temperature', 25.0) for r in sensor_readings if r.get('temperature')]),
-            'ambient_temp': np.mean([r.get('ambient_temp', 22.0) for r in sensor_readings if r.get('ambient_temp')]),
-            'tds': np.mean([r.get('tds', 300.0) for r in sensor_readings if r.get('tds')]),
-            'ph': np.mean([r.get('ph', 7.0) for r in sensor_readings if r.get('ph')]),
-            'tank_volume': 200.0  # TODO: Get from config
+            key: averages[key] if averages[key] is not None else default
+            for key, default in defaults.items()
         }
+        sensor_data['tank_volume'] = 200.0  # TODO: Get from config
         
         # Temperature PID
         temp_gains = self.pid_temp.predict(sensor_data, season)
@@ -1095,13 +2033,22 @@ class AquariumMLService:
     
     def run_once(self, pid_only=False, wc_only=False):
         """Run training once and exit"""
-        if not wc_only:
-            self.train_all_pid_models()
-        
-        if not pid_only:
-            self.train_wc_model()
+        # One MQTT session carries every publish of this run; its handshake
+        # overlaps the DB fetch and training that precede the first publish
+        self.mqtt.connect(background=True)
         
-        logger.info("\nTraining complete!")
+        try:
+            if not wc_only:
+                self.train_all_pid_models()
+            
+            if not pid_only:
+                self.train_wc_model()
+            
+            logger.info("\nTraining complete!")
+        finally:
+            self.mqtt.disconnect()
+            self.mqtt_db.close()
+            self.db.close()
     
     def run_service(self):
         """Run as persistent service"""
@@ -1111,12 +2058,7 @@ class AquariumMLService:
         self.mqtt.connect()
         
         # Wait for MQTT connection
-        timeout = 10
-        while not self.mqtt.connected and timeout > 0:
-            time.sleep(1)
-            timeout -= 1
-        
-        if not self.mqtt.connected:
+        if not self.mqtt.wait_for_connection():
             logger.error("Failed to connect to MQTT broker")
             return
         
@@ -1127,12 +2069,18 @@ class AquariumMLService:
             self.train_all_pid_models()
             self.train_wc_model()
         except Exception as e:
-            logger.error(f"Initial training error: {e}")
+            logger.error("Initial training error: %s", e)
         
         # Main service loop
         try:
             while not shutdown_requested:
-                time.sleep(60)  # Check every minute
+                service_wakeup.wait(timeout=SERVICE_TICK)
+                service_wakeup.clear()
+                if shutdown_requested:
+                    break
+                
+                # Don't leave a partial batch behind if sensor data stops
+                self.mqtt.flush_sensor_readings()
                 
                 current_time = time.time()
                 current_season = (datetime.now().month - 1) // 3
@@ -1144,20 +2092,23 @@ class AquariumMLService:
                         logger.info("\nScheduled PID training...")
                         self.train_all_pid_models()
                     except Exception as e:
-                        logger.error(f"PID training error: {e}")
+                        logger.error("PID training error: %s", e)
                 
-                # Check if water change training is needed
-                if (current_time - self.last_wc_train) > WC_TRAIN_INTERVAL:
+                # Check if water change training is needed: on schedule, or
+                # early once enough new events arrived over MQTT
+                if (current_time - self.last_wc_train) > WC_TRAIN_INTERVAL or \
+                   self.wc_predictor.enough_new_data():
                     try:
                         logger.info("\nScheduled water change training...")
                         self.train_wc_model()
                     except Exception as e:
-                        logger.error(f"Water change training error: {e}")
+                        logger.error("Water change training error: %s", e)
         
         except KeyboardInterrupt:
             logger.info("\nShutdown requested by user")
         finally:
             self.mqtt.disconnect()
+            self.mqtt_db.close()
             self.db.close()
             logger.info("Service stopped")
 
@@ -1169,8 +2120,9 @@ class AquariumMLService:
 def signal_handler(signum, frame):
     """Handle shutdown signals"""
     global shutdown_requested
-    logger.info(f"\nReceived signal {signum}")
+    logger.info("\nReceived signal %s", signum)
     shutdown_requested = True
+    service_wakeup.set()
 
 
 # ============================================================================
@@ -2,9 +2,23 @@
 # Quick Test Runner for Water Change ML Service
 #
 # This script provides an easy way to run all tests for the ML service
+#
+# Usage: ./run_tests.sh [-y|--yes]
+#   -y, --yes   Run integration tests without prompting (for CI and repeated runs)
 
 set -e  # Exit on error
 
+ASSUME_YES=0
+for arg in "$@"; do
+    case "$arg" in
+        -y|--yes) ASSUME_YES=1 ;;
+        *)
+            echo "Usage: $0 [-y|--yes]"
+            exit 1
+            ;;
+    esac
+done
+
 # Colors for output
 GREEN='\033[0;32m'
 YELLOW='\033[1;33m'
@@ -17,8 +31,8 @@ echo "======================================================================"
 echo ""
 
 # Check if we're in the right directory
-if [ ! -f "test_ml_service.py" ]; then
-    echo -e "${RED}Error: test_ml_service.py not found!${NC}"
+if [ ! -f "test_aquarium_ml_service.py" ]; then
+    echo -e "${RED}Error: test_aquarium_ml_service.py not found!${NC}"
     echo "Please run this script from the tools/ directory"
     exit 1
 fi
@@ -37,7 +51,7 @@ echo "======================================================================"
 echo "Running Unit Tests (fast, no database required)"
 echo "======================================================================"
 echo ""
-python3 test_ml_service.py
+python3 test_aquarium_ml_service.py
 
 # Check if unit tests passed
 if [ $? -eq 0 ]; then
@@ -52,8 +66,12 @@ if [ $? -eq 0 ]; then
     echo ""
     echo "Integration tests require MariaDB to be running with a test database."
     echo ""
-    read -p "Do you want to run integration tests? (y/n) " -n 1 -r
-    echo ""
+    if [ "$ASSUME_YES" -eq 1 ]; then
+        REPLY=y
+    else
+        read -p "Do you want to run integration tests? (y/n) " -n 1 -r
+        echo ""
+    fi
     
     if [[ $REPLY =~ ^[Yy]$ ]]; then
         # Check if .env.test exists
@@ -66,13 +84,13 @@ if [ $? -eq 0 ]; then
             echo "  nano .env.test"
             echo ""
             echo "Then run integration tests with:"
-            echo "  python3 test_ml_integration.py"
+            echo "  python3 test_integration.py"
             exit 0
         fi
         
         echo ""
         echo "Running integration tests..."
-        python3 test_ml_integration.py
+        python3 test_integration.py
         
         if [ $? -eq 0 ]; then
             echo ""
@@ -94,7 +112,7 @@ if [ $? -eq 0 ]; then
         echo "To run integration tests later:"
         echo "  1. Set up test database (see MARIADB_SETUP_GUIDE.md)"
         echo "  2. Configure .env.test"
-        echo "  3. Run: python3 test_ml_integration.py"
+        echo "  3. Run: python3 test_integration.py"
     fi
 else
     echo ""
@@ -13,13 +13,20 @@ Usage:
     pytest test_aquarium_ml_service.py -v
 """
 
+import copy
 import json
+import os
+import shutil
 import sys
+import tempfile
+import threading
 import time
 import unittest
 from datetime import datetime
 from unittest.mock import MagicMock, Mock, patch
 
+import joblib
+import mysql.connector
 import numpy as np
 
 # Add parent directory to path
@@ -30,10 +37,42 @@ from aquarium_ml_service import (
     PIDOptimizer,
     WaterChangePredictor,
     MQTTManager,
-    AquariumMLService
+    AquariumMLService,
+    PID_HISTORY_DTYPE,
+    water_change_features
 )
 
 
+WC_ROW_TEMPLATE = {
+    'tds_before': 320.0,
+    'tds_after': 210.0,
+    'volume_litres': 40.0,
+    'completed': 1
+}
+
+
+def _bulk_wcs(count, base_time, interval_days, **columns):
+    """Build water change history rows, newest first, from NumPy columns
+    
+    Keyword arguments override template fields with a per-row array or a scalar.
+    """
+    end_times = (base_time - np.arange(count) * interval_days * 86400).tolist()
+    overrides = {k: np.broadcast_to(v, count).tolist() for k, v in columns.items()}
+    return [
+        {**WC_ROW_TEMPLATE, 'end_timestamp': t, **{k: v[i] for k, v in overrides.items()}}
+        for i, t in enumerate(end_times)
+    ]
+
+
+def _wc_columns(rows):
+    """Columnar form of history rows, as get_water_change_history(columnar=True) returns"""
+    return {
+        name: np.array([np.nan if row.get(name) is None else row[name] for row in rows],
+                       dtype=np.float64)
+        for name in AquariumDatabase.WATER_CHANGE_COLUMNS
+    }
+
+
 class TestAquariumDatabase(unittest.TestCase):
     """Test database operations"""
     
@@ -42,11 +81,70 @@ class TestAquariumDatabase(unittest.TestCase):
         """Set up test database"""
         self.mock_conn = Mock()
         self.mock_cursor = Mock()
+        self.mock_cursor.rowcount = 0
         self.mock_conn.cursor.return_value = self.mock_cursor
         mock_connect.return_value = self.mock_conn
         
         self.db = AquariumDatabase('localhost', 3306, 'test', 'test', 'test')
     
+    @patch('aquarium_ml_service.mysql.connector.connect')
+    @patch('aquarium_ml_service.os.path.exists')
+    def test_connection_transport(self, mock_exists, mock_connect):
+        """Test local hosts use the Unix socket and remote hosts use compression"""
+        mock_connect.return_value = self.mock_conn
+        
+        mock_exists.return_value = True
+        local = AquariumDatabase('localhost', 3306, 'test', 'test', 'test')
+        self.assertIn('unix_socket', local.db_config)
+        self.assertNotIn('compress', local.db_config)
+        
+        remote = AquariumDatabase('db.example.com', 3306, 'test', 'test', 'test')
+        self.assertNotIn('unix_socket', remote.db_config)
+        self.assertTrue(remote.db_config['compress'])
+    
+    @patch('aquarium_ml_service.mysql.connector.connect')
+    def test_existing_index_is_tolerated(self, mock_connect):
+        """Test startup ignores an index that already exists (MySQL has no IF NOT EXISTS)"""
+        def execute(sql, *args):
+            if 'CREATE INDEX' in sql:
+                raise mysql.connector.Error(msg="Duplicate key name", errno=1061)
+        self.mock_cursor.execute.side_effect = execute
+        mock_connect.return_value = self.mock_conn
+        
+        AquariumDatabase('localhost', 3306, 'test', 'test', 'test')
+        
+        def execute_fails(sql, *args):
+            if 'CREATE INDEX' in sql:
+                raise mysql.connector.Error(msg="Access denied", errno=1142)
+        self.mock_cursor.execute.side_effect = execute_fails
+        with self.assertRaises(mysql.connector.Error):
+            AquariumDatabase('localhost', 3306, 'test', 'test', 'test')
+    
+    @patch('aquarium_ml_service.mysql.connector.connect')
+    def test_pool_per_configuration(self, mock_connect):
+        """Test instances share a connection pool only when their settings match"""
+        mock_connect.return_value = self.mock_conn
+        
+        same = AquariumDatabase('localhost', 3306, 'test', 'test', 'test', create_tables=False)
+        infile = AquariumDatabase('localhost', 3306, 'test', 'test', 'test', allow_local_infile=True)
+        other_db = AquariumDatabase('localhost', 3306, 'other', 'test', 'test')
+        
+        self.assertEqual(same.db_config['pool_name'], self.db.db_config['pool_name'])
+        self.assertNotEqual(infile.db_config['pool_name'], self.db.db_config['pool_name'])
+        self.assertNotEqual(other_db.db_config['pool_name'], self.db.db_config['pool_name'])
+        self.assertLessEqual(len(self.db.db_config['pool_name']), 64)
+    
+    def test_close_rolls_back_open_transaction(self):
+        """Test a connection is never returned to the pool mid-transaction"""
+        self.mock_conn.is_connected.return_value = True
+        self.db.begin()
+        
+        self.db.close()
+        
+        self.mock_conn.rollback.assert_called_once()
+        self.mock_conn.close.assert_called_once()
+        self.assertFalse(self.db._in_transaction)
+    
     def test_store_sensor_reading(self):
         """Test storing sensor reading"""
         data = {
@@ -59,12 +157,102 @@ class TestAquariumDatabase(unittest.TestCase):
             'co2State': 'OFF'
         }
         
+        self.mock_cursor.execute.reset_mock()
+        
         self.db.store_sensor_reading(data)
         
-        # Verify INSERT was called
-        self.mock_cursor.execute.assert_called()
-        call_args = self.mock_cursor.execute.call_args[0]
-        self.assertIn('INSERT INTO sensor_readings', call_args[0])
+        # Buffered until flushed, then written as one batch
+        self.mock_cursor.execute.assert_not_called()
+        self.mock_cursor.executemany.assert_not_called()
+        
+        self.db.flush_sensor_readings()
+        
+        self.mock_cursor.executemany.assert_called_once()
+        sql, rows = self.mock_cursor.executemany.call_args[0]
+        self.assertIn('INSERT INTO sensor_readings', sql)
+        self.assertEqual(rows[0][1:], (24.5, 22.0, 7.2, 300.0, 1, 0))
+    
+    def test_store_sensor_reading_flushes_full_buffer(self):
+        """Test a full buffer of readings is written with one executemany"""
+        data = {'timestamp': int(time.time()), 'temperature': 24.5, 'tds': 300.0}
+        self.mock_conn.commit.reset_mock()
+        
+        for _ in range(50):
+            self.db.store_sensor_reading(data)
+        
+        self.mock_cursor.executemany.assert_called_once()
+        self.assertEqual(len(self.mock_cursor.executemany.call_args[0][1]), 50)
+        self.mock_conn.commit.assert_not_called()  # autocommit, no extra round trip
+        self.assertEqual(self.db._sensor_buffer, [])
+    
+    def test_ensure_connection_throttles_ping(self):
+        """Test a recently verified connection is reused without a COM_PING"""
+        self.mock_conn.is_connected.reset_mock()
+        
+        for _ in range(5):
+            self.db.ensure_connection()
+        self.assertEqual(self.mock_conn.is_connected.call_count, 1)
+        
+        # Once the interval has passed the connection is checked again
+        self.db._last_ping -= 60
+        self.db.ensure_connection()
+        self.assertEqual(self.mock_conn.is_connected.call_count, 2)
+    
+    def test_store_sensor_reading_reuses_prepared_cursor(self):
+        """Test repeated single-row inserts in a transaction prepare the statement once"""
+        data = {'timestamp': int(time.time()), 'temperature': 24.5, 'tds': 300.0}
+        self.mock_conn.cursor.reset_mock()
+        self.mock_cursor.execute.reset_mock()
+        
+        with self.db.transaction():
+            for _ in range(3):
+                self.db.store_sensor_reading(data)
+        
+        self.mock_conn.cursor.assert_called_once_with(prepared=True)
+        self.assertEqual(self.mock_cursor.execute.call_count, 3)
+    
+    def test_reconnect_closes_prepared_cursors(self):
+        """Test prepared statements are closed, not just forgotten, on reconnect"""
+        stale = Mock()
+        stale.close.side_effect = Exception("connection lost")
+        live = Mock()
+        self.db._prepared = {'a': stale, 'b': live}
+        
+        with patch('aquarium_ml_service.mysql.connector.connect', return_value=self.mock_conn):
+            self.db.reconnect()
+        
+        stale.close.assert_called_once()
+        live.close.assert_called_once()
+        self.assertEqual(self.db._prepared, {})
+    
+    def test_store_retries_once_after_dropped_connection(self):
+        """Test a write on a connection dropped inside the ping window reconnects and retries"""
+        self.db._last_ping = time.monotonic()  # connection is trusted, no ping
+        self.mock_cursor.execute.reset_mock()
+        self.mock_cursor.execute.side_effect = [
+            mysql.connector.OperationalError("MySQL server has gone away"), None]
+        self.mock_conn.is_connected.return_value = False
+        fresh_conn = Mock()
+        fresh_conn.cursor.return_value = self.mock_cursor
+        
+        with patch('aquarium_ml_service.mysql.connector.connect', return_value=fresh_conn):
+            self.db.store_water_change({'startTime': 1000, 'endTime': 2000, 'volume': 20.0})
+        
+        self.assertEqual(self.mock_cursor.execute.call_count, 2)
+        self.assertIs(self.db.conn, fresh_conn)
+        fresh_conn.commit.assert_called_once()
+    
+    def test_store_does_not_retry_inside_transaction(self):
+        """Test a dropped connection mid-transaction is raised, not replayed on a fresh session"""
+        self.mock_cursor.execute.reset_mock()
+        self.mock_cursor.execute.side_effect = mysql.connector.OperationalError("Lost connection")
+        
+        with self.assertRaises(mysql.connector.OperationalError):
+            with self.db.transaction():
+                self.db.store_water_change({'startTime': 1000, 'endTime': 2000, 'volume': 20.0})
+        
+        self.mock_cursor.execute.assert_called_once()
+        self.mock_conn.rollback.assert_called_once()
     
     def test_store_pid_performance(self):
         """Test storing PID performance data"""
@@ -95,9 +283,10 @@ class TestAquariumDatabase(unittest.TestCase):
     
     def test_store_water_change(self):
         """Test storing water change event"""
+        now = int(time.time())
         wc_data = {
-            'startTime': int(time.time()) - 3600,
-            'endTime': int(time.time()),
+            'startTime': now - 3600,
+            'endTime': now,
             'volume': 40.0,
             'tempBefore': 24.5,
             'tempAfter': 23.8,
@@ -115,6 +304,206 @@ class TestAquariumDatabase(unittest.TestCase):
         self.mock_cursor.execute.assert_called()
         call_args = self.mock_cursor.execute.call_args[0]
         self.assertIn('INSERT INTO water_changes', call_args[0])
+    
+    def test_store_water_changes_bulk(self):
+        """Test storing a batch of water change events in one round trip"""
+        now = int(time.time())
+        wc_list = [
+            {
+                'startTime': now - (i * 14 * 86400) - 3600,
+                'endTime': now - (i * 14 * 86400),
+                'volume': 40.0,
+                'tdsBefore': 320.0,
+                'tdsAfter': 210.0,
+                'successful': True
+            }
+            for i in range(12)
+        ]
+        self.mock_conn.commit.reset_mock()
+        self.mock_cursor.rowcount = 12
+        
+        inserted = self.db.store_water_changes_bulk(wc_list)
+        
+        # One executemany carrying every row, one commit, rowcount passed back
+        self.assertEqual(inserted, 12)
+        self.mock_cursor.executemany.assert_called_once()
+        sql, params = self.mock_cursor.executemany.call_args[0]
+        self.assertIn('INSERT INTO water_changes', sql)
+        self.assertEqual(len(params), 12)
+        self.assertEqual(params[0][1], now)
+        self.mock_conn.commit.assert_called_once()
+    
+    def test_store_filter_maintenance_bulk(self):
+        """Test storing a batch of filter maintenance events in one round trip"""
+        now = int(time.time())
+        fm_list = [
+            {'timestamp': now - (i * 90 * 86400), 'filter_type': 'mechanical'}
+            for i in range(3)
+        ]
+        self.mock_conn.commit.reset_mock()
+        
+        self.db.store_filter_maintenance_bulk(fm_list)
+        
+        self.mock_cursor.executemany.assert_called_once()
+        sql, params = self.mock_cursor.executemany.call_args[0]
+        self.assertIn('INSERT INTO filter_maintenance', sql)
+        self.assertEqual(len(params), 3)
+        self.mock_conn.commit.assert_called_once()
+    
+    def test_store_wc_predictions_bulk(self):
+        """Test storing a batch of water change predictions in one round trip"""
+        rows = [(3.5, 0.82, 'gradient_boost'), (4.0, 0.75, 'linear')]
+        self.mock_conn.commit.reset_mock()
+        
+        self.db.store_wc_predictions_bulk(rows)
+        
+        self.mock_cursor.executemany.assert_called_once()
+        sql, params = self.mock_cursor.executemany.call_args[0]
+        self.assertIn('INSERT INTO wc_predictions', sql)
+        self.assertEqual([p[1:] for p in params], rows)
+        self.mock_conn.commit.assert_called_once()
+    
+    def test_store_sensor_readings_bulk(self):
+        """Test storing precomputed sensor columns as raw tuples"""
+        n = 100
+        ts = 1700000000 - np.arange(n) * 300
+        temps = 25.5 + np.arange(n) * 0.01
+        heaters = (np.arange(n) % 2 == 0).astype(int)
+        rows = list(zip(ts.tolist(), temps.tolist(), [22.3] * n, [6.8] * n,
+                        [300.0] * n, heaters.tolist(), [1] * n))
+        self.mock_cursor.rowcount = n
+        self.mock_conn.commit.reset_mock()
+        
+        inserted = self.db.store_sensor_readings_bulk(rows)
+        
+        self.assertEqual(inserted, n)
+        self.mock_cursor.executemany.assert_called_once()
+        sql, params = self.mock_cursor.executemany.call_args[0]
+        self.assertIn('INSERT INTO sensor_readings', sql)
+        self.assertEqual(params, rows)
+        self.mock_conn.commit.assert_not_called()
+    
+    @patch('aquarium_ml_service.BULK_INSERT_BATCH_SIZE', 40)
+    def test_bulk_insert_chunks_large_batches(self):
+        """Test bulk inserts are split into BULK_INSERT_BATCH_SIZE executemany calls"""
+        rows = [(1700000000 + i, 24.5, 22.0, 7.0, 300.0, 0, 1) for i in range(100)]
+        self.mock_cursor.rowcount = 40
+        
+        self.db.store_sensor_readings_bulk(rows)
+        
+        chunk_sizes = [len(c[0][1]) for c in self.mock_cursor.executemany.call_args_list]
+        self.assertEqual(chunk_sizes, [40, 40, 20])
+    
+    def test_load_csv(self):
+        """Test LOAD DATA streams a temp CSV with checks disabled and removes it"""
+        rows = [(1700000000, 24.5, None), (1700000300, 24.6, 22.0)]
+        self.mock_cursor.rowcount = 2
+        self.mock_cursor.execute.reset_mock()
+        
+        with patch('aquarium_ml_service.os.unlink') as mock_unlink:
+            loaded = self.db.load_csv('sensor_readings',
+                                      ['timestamp', 'temperature', 'ambient_temp'], rows)
+            statements = [c[0][0] for c in self.mock_cursor.execute.call_args_list]
+            sql, params = self.mock_cursor.execute.call_args_list[1][0]
+            with open(params[0], newline='') as f:
+                contents = f.read()
+            mock_unlink.assert_any_call(params[0])
+        os.unlink(params[0])
+        
+        self.assertEqual(loaded, 2)
+        self.assertEqual(statements[0], "SET unique_checks=0, foreign_key_checks=0")
+        self.assertIn('LOAD DATA LOCAL INFILE', sql)
+        self.assertEqual(statements[-1], "SET unique_checks=1, foreign_key_checks=1")
+        self.assertIn('(timestamp, temperature, ambient_temp)', sql)
+        self.assertEqual(contents, '1700000000,24.5,\\N\r\n1700000300,24.6,22.0\r\n')
+    
+    def test_get_sensor_averages(self):
+        """Test sensor averages come from one aggregate query and map NULL to None"""
+        self.mock_cursor.fetchone.return_value = (24.5, None, 7.1, 305.0, 12)
+        
+        averages = self.db.get_sensor_averages(hours=1)
+        
+        sql = self.mock_cursor.execute.call_args[0][0]
+        self.assertIn('AVG(NULLIF(tds, 0))', sql)
+        self.assertEqual(averages, {
+            'temperature': 24.5, 'ambient_temp': None, 'ph': 7.1, 'tds': 305.0, 'count': 12
+        })
+    
+    def test_get_water_change_history_columnar(self):
+        """Test the columnar history maps each feature column to a float array"""
+        self.mock_cursor.fetchall.return_value = [
+            (1698790400, None, 200.0, 40.0),
+            (1700000000, 320.0, 210.0, 40.0)
+        ]
+        
+        history = self.db.get_water_change_history(limit=2, columnar=True)
+        
+        self.assertEqual(set(history), set(AquariumDatabase.WATER_CHANGE_COLUMNS))
+        np.testing.assert_array_equal(history['end_timestamp'], [1698790400, 1700000000])
+        self.assertTrue(np.isnan(history['tds_before'][0]))
+        self.assertEqual(history['volume_litres'].dtype, np.float64)
+    
+    def test_get_pid_performance_history_streams_into_record_array(self):
+        """Test PID history is fetched in batches into a struct-of-arrays buffer"""
+        row = (1700000000, 10.0, 0.5, 5.0, 12.0, None, 24.5, 22.0, 300.0, 7.2, 14, 200.0)
+        self.mock_cursor.fetchmany.side_effect = [[row] * 3, [row] * 2, []]
+        
+        history = self.db.get_pid_performance_history('temp', season=1, limit=10)
+        
+        self.assertEqual(history.dtype, PID_HISTORY_DTYPE)
+        self.assertEqual(len(history), 5)
+        self.assertEqual(self.mock_cursor.fetchmany.call_count, 3)
+        np.testing.assert_array_equal(history['kp'], 10.0)
+        self.assertTrue(np.all(np.isnan(history['overshoot'])))
+    
+    def test_transaction_defers_commit(self):
+        """Test store_* calls inside a transaction share a single commit"""
+        data = {'timestamp': int(time.time()), 'temperature': 24.5, 'tds': 300.0}
+        self.mock_cursor.execute.reset_mock()
+        self.mock_conn.commit.reset_mock()
+        
+        with self.db.transaction():
+            for _ in range(5):
+                self.db.store_sensor_reading(data)
+        
+        self.assertEqual(self.mock_cursor.execute.call_count, 5)
+        self.mock_conn.start_transaction.assert_called_once()
+        self.mock_conn.commit.assert_called_once()
+    
+    def test_transaction_rolls_back_on_error(self):
+        """Test a failing transaction is rolled back instead of committed"""
+        self.mock_conn.commit.reset_mock()
+        
+        with self.assertRaises(ValueError):
+            with self.db.transaction():
+                self.db.store_sensor_reading({'temperature': 24.5})
+                raise ValueError("boom")
+        
+        self.mock_conn.rollback.assert_called_once()
+        self.mock_conn.commit.assert_not_called()
+    
+    def test_failed_store_rolls_back_transaction(self):
+        """Test a store_* failure inside a transaction rolls back the earlier writes"""
+        self.mock_conn.commit.reset_mock()
+        self.mock_cursor.execute.side_effect = [
+            None, mysql.connector.DatabaseError("Data too long for column")]
+        
+        with self.assertRaises(mysql.connector.DatabaseError):
+            with self.db.transaction():
+                self.db.store_water_change({'startTime': 1000, 'endTime': 2000, 'volume': 20.0})
+                self.db.store_filter_maintenance({'timestamp': 2000, 'notes': 'x' * 70000})
+        
+        self.mock_conn.rollback.assert_called_once()
+        self.mock_conn.commit.assert_not_called()
+        self.assertFalse(self.db._in_transaction)
+    
+    def test_failed_store_outside_transaction_is_logged(self):
+        """Test a store_* failure without a transaction is logged, not raised"""
+        self.mock_cursor.execute.side_effect = mysql.connector.DatabaseError("Data too long for column")
+        
+        with self.assertLogs('aquarium_ml_service', level='ERROR'):
+            self.db.store_water_change({'startTime': 1000, 'endTime': 2000, 'volume': 20.0})
+        self.mock_conn.rollback.assert_not_called()
 
 
 class TestPIDOptimizer(unittest.TestCase):
@@ -129,34 +518,32 @@ class TestPIDOptimizer(unittest.TestCase):
         mock_connect.return_value = self.mock_conn
         
         self.db = AquariumDatabase('localhost', 3306, 'test', 'test', 'test')
-        self.optimizer = PIDOptimizer(self.db, 'temp')
+        self.optimizer = PIDOptimizer(self.db, 'temp', cache_dir=None)
     
     def test_extract_features(self):
         """Test feature extraction from performance history"""
-        # Create sample history
-        history = []
-        for i in range(100):
-            history.append({
-                'timestamp': int(time.time()) - (i * 3600),
-                'kp': 10.0 + np.random.randn() * 0.5,
-                'ki': 0.5 + np.random.randn() * 0.05,
-                'kd': 5.0 + np.random.randn() * 0.3,
-                'settling_time': 12.0 + np.random.randn() * 2.0,
-                'overshoot': 0.3 + np.random.randn() * 0.1,
-                'steady_state_error': 0.05,
-                'temperature': 24.5,
-                'ambient_temp': 22.0,
-                'tds': 300.0,
-                'ph': 7.2,
-                'hour': 14,
-                'tank_volume': 200.0
-            })
+        # Create sample history as a PID_HISTORY_DTYPE record array
+        n = 100
+        history = np.zeros(n, dtype=PID_HISTORY_DTYPE)
+        history['timestamp'] = int(time.time()) - np.arange(n) * 3600
+        history['kp'] = 10.0 + np.random.randn(n) * 0.5
+        history['ki'] = 0.5 + np.random.randn(n) * 0.05
+        history['kd'] = 5.0 + np.random.randn(n) * 0.3
+        history['settling_time'] = 12.0 + np.random.randn(n) * 2.0
+        history['overshoot'] = 0.3 + np.random.randn(n) * 0.1
+        history['temperature'] = 24.5
+        history['ambient_temp'] = 22.0
+        history['tds'] = 300.0
+        history['ph'] = 7.2
+        history['hour'] = 14
+        history['tank_volume'] = 200.0
         
         X, y_kp, y_ki, y_kd, weights = self.optimizer.extract_features(history)
         
         # Verify shapes
         self.assertEqual(X.shape[0], 100)
         self.assertEqual(X.shape[1], 7)  # 7 features
+        self.assertEqual(X.dtype, np.float32)
         self.assertEqual(len(y_kp), 100)
         self.assertEqual(len(y_ki), 100)
         self.assertEqual(len(y_kd), 100)
@@ -168,8 +555,8 @@ class TestPIDOptimizer(unittest.TestCase):
     def test_train_season_insufficient_data(self):
         """Test training with insufficient data"""
         # Mock insufficient data
-        self.mock_cursor.fetchall.return_value = []
-        self.mock_cursor.description = [('id',), ('timestamp',)]
+        self.mock_cursor.fetchone.return_value = (0, None)
+        self.mock_cursor.fetchmany.return_value = []
         
         result = self.optimizer.train_season(0)
         
@@ -204,28 +591,22 @@ class TestWaterChangePredictor(unittest.TestCase):
         mock_connect.return_value = self.mock_conn
         
         self.db = AquariumDatabase('localhost', 3306, 'test', 'test', 'test')
-        self.predictor = WaterChangePredictor(self.db)
+        self.predictor = WaterChangePredictor(self.db, cache_dir=None)
     
     def test_extract_features(self):
         """Test feature extraction from water change history"""
-        # Create sample history
-        history = []
+        # Create sample history, every 14 days
         base_ts = int(time.time())
-        for i in range(10):
-            history.append({
-                'end_timestamp': base_ts - (i * 14 * 86400),  # Every 14 days
-                'tds_before': 320.0 + np.random.randn() * 20,
-                'tds_after': 210.0 + np.random.randn() * 10,
-                'volume_litres': 40.0,
-                'completed': 1
-            })
+        history = _bulk_wcs(10, base_ts, 14,
+                            tds_before=320.0 + np.random.randn(10) * 20,
+                            tds_after=210.0 + np.random.randn(10) * 10)
         
-        # Need last filter maintenance
-        self.mock_cursor.fetchone.return_value = (1, base_ts - 30 * 86400, 'mechanical', 30, 300, 280, '')
-        self.mock_cursor.description = [('id',), ('timestamp',), ('filter_type',), 
-                                         ('days_since_last',), ('tds_before',), ('tds_after',), ('notes',)]
+        # Filter maintenance timestamps, then the 24h sensor averages
+        self.mock_cursor.fetchall.return_value = [(base_ts - 300 * 86400,)]
+        self.mock_cursor.fetchone.return_value = (None, None, None, None, 0)
         
-        X, y = self.predictor.extract_features(history)
+        # Columnar history is chronological
+        X, y = self.predictor.extract_features(_wc_columns(history[::-1]))
         
         # Verify shapes
         self.assertEqual(X.shape[0], 9)  # 10 records - 1 (need previous)
@@ -235,9 +616,40 @@ class TestWaterChangePredictor(unittest.TestCase):
         # Verify all features are positive
         self.assertTrue(np.all(X >= 0))
     
+    def test_water_change_features_vectorised(self):
+        """Test pairwise feature maths and that incomplete changes are dropped"""
+        day = 86400.0
+        end_ts = np.array([0.0, 14 * day, 28 * day, 42 * day])
+        tds_before = np.array([300.0, 320.0, np.nan, 340.0])
+        tds_after = np.array([200.0, 210.0, 220.0, 230.0])
+        volume = np.array([40.0, 40.0, 40.0, 50.0])
+        
+        fm_ts = np.array([7 * day])
+        
+        X, y = water_change_features(end_ts, tds_before, tds_after, volume, 21.5, fm_ts)
+        
+        # Change 2 has no tds_before, so only the pairs ending at 1 and 3 remain
+        self.assertEqual(X.dtype, np.float32)
+        np.testing.assert_allclose(y, [14.0, 14.0])
+        np.testing.assert_allclose(X[0], [14.0, 320.0, (320.0 - 200.0) / 14.0, 20.0, 21.5, 7.0], rtol=1e-6)
+        np.testing.assert_allclose(X[1], [14.0, 340.0, (340.0 - 220.0) / 14.0, 25.0, 21.5, 35.0], rtol=1e-6)
+    
+    def test_water_change_features_pair_each_change_with_prior_maintenance(self):
+        """Test days since filter maintenance uses the maintenance before each change"""
+        day = 86400.0
+        end_ts = np.array([0.0, 14 * day, 28 * day, 42 * day])
+        tds = np.full(4, 300.0)
+        fm_ts = np.array([20 * day, 28 * day, 50 * day])
+        
+        X, _ = water_change_features(end_ts, tds, tds, np.full(4, 40.0), 22.0, fm_ts)
+        
+        # None before day 14, same-day at 28, day 28 again for 42; day 50 is later
+        np.testing.assert_allclose(X[:, 5], [30.0, 0.0, 14.0])
+    
     def test_train_insufficient_data(self):
         """Test training with insufficient data"""
-        # Mock insufficient data
+        # Mock insufficient data: fingerprint and sensor averages, then no history
+        self.mock_cursor.fetchone.side_effect = [(0, None, None), (None, None, None, None, 0)]
         self.mock_cursor.fetchall.return_value = []
         
         result = self.predictor.train()
@@ -253,6 +665,217 @@ class TestWaterChangePredictor(unittest.TestCase):
         self.assertEqual(result['error'], 'no_model')
 
 
+class TestWaterChangePredictorTrained(unittest.TestCase):
+    """Test water change prediction against a predictor trained once per class"""
+    
+    @classmethod
+    def setUpClass(cls):
+        """Train the ensemble once; fitting dominates the runtime of these tests"""
+        base_ts = int(time.time())
+        
+        # Newest first, matching get_water_change_history ordering; the
+        # columnar form is the same latest rows oldest first
+        cls.history = _bulk_wcs(15, base_ts, 14, tds_before=320.0 + (np.arange(15) % 3) * 10.0)
+        
+        cls.db = Mock()
+        cls.db.get_water_change_history.side_effect = (
+            lambda limit=50, columnar=False: _wc_columns(cls.history[:limit][::-1]) if columnar
+            else cls.history[:limit]
+        )
+        cls.db.get_training_fingerprint.return_value = (15, 15, None)
+        cls.db.get_last_filter_maintenance.return_value = None
+        cls.db.get_filter_maintenance_timestamps.return_value = np.empty(0, dtype=np.int64)
+        cls.db.get_sensor_averages.return_value = {
+            'temperature': None, 'ambient_temp': None, 'ph': None, 'tds': None, 'count': 0
+        }
+        
+        cls.trained_predictor = WaterChangePredictor(cls.db, cache_dir=None)
+        cls.train_result = cls.trained_predictor.train()
+    
+    def setUp(self):
+        """Give each test its own copy of the fitted models, sharing the mock db"""
+        memo = {id(self.db): self.db,
+                id(self.trained_predictor._new_events_lock): threading.Lock()}
+        self.predictor = copy.deepcopy(self.trained_predictor, memo)
+    
+    def test_train_selects_best_model(self):
+        """Test training picks one of the candidate models"""
+        self.assertNotIn('error', self.train_result)
+        self.assertIn(self.train_result['model'], self.trained_predictor.models)
+        self.assertEqual(self.train_result['training_samples'], len(self.history) - 1)
+    
+    def test_predict_after_training(self):
+        """Test prediction output from a trained predictor"""
+        result = self.predictor.predict()
+        
+        self.assertNotIn('error', result)
+        self.assertGreaterEqual(result['predicted_days_remaining'], 0)
+        self.assertGreaterEqual(result['confidence'], 0.6)
+        self.assertEqual(result['model'], self.train_result['model'])
+    
+    def test_predict_confidence_from_training_score(self):
+        """Test confidence comes from the training R², discounted for little data"""
+        self.predictor.best_score = 0.9
+        
+        self.predictor.samples_at_last_train = 40
+        self.assertEqual(self.predictor.predict()['confidence'], 0.9)
+        
+        self.predictor.samples_at_last_train = 16
+        self.assertEqual(self.predictor.predict()['confidence'], 0.72)
+    
+    def test_extract_features_queries_sensors_once(self):
+        """Test the 24h sensor window is fetched once, not once per water change"""
+        db = Mock()
+        db.get_filter_maintenance_timestamps.return_value = np.empty(0, dtype=np.int64)
+        db.get_sensor_averages.return_value = {
+            'temperature': 25.0, 'ambient_temp': 22.0, 'ph': 7.0, 'tds': 300.0, 'count': 2
+        }
+        predictor = WaterChangePredictor(db, cache_dir=None)
+        
+        X, y = predictor.extract_features(_wc_columns(self.history[::-1]))
+        
+        db.get_sensor_averages.assert_called_once_with(hours=24)
+        self.assertTrue(np.all(X[:, 4] == 22.0))
+    
+    def test_model_cache_skips_refit(self):
+        """Test unchanged training data loads the cached fit instead of refitting"""
+        with tempfile.TemporaryDirectory() as cache_dir:
+            first = WaterChangePredictor(self.db, cache_dir=cache_dir)
+            self.assertNotIn('cached', first.train())
+            
+            second = WaterChangePredictor(self.db, cache_dir=cache_dir)
+            with patch.object(second.scaler, 'fit_transform') as mock_fit:
+                result = second.train()
+            
+            mock_fit.assert_not_called()
+            self.assertTrue(result['cached'])
+            self.assertEqual(result['model'], first.best_model_name)
+            self.assertEqual(second.predict()['predicted_total_cycle_days'],
+                             first.predict()['predicted_total_cycle_days'])
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+    
+    def test_tree_models_skip_scaler(self):
+        """Test only the linear model sees scaled features"""
+        predictor = self.predictor
+        predictor.best_model_name = 'hist_gradient_boost'
+        predictor.best_model = predictor.models['hist_gradient_boost']
+        
+        with patch.object(predictor.scaler, 'transform') as mock_transform:
+            predictor.predict()
+        mock_transform.assert_not_called()
+        
+        predictor.best_model_name = 'linear'
+        predictor.best_model = predictor.models['linear']
+        with patch.object(predictor.scaler, 'transform',
+                          side_effect=predictor.scaler.transform) as mock_transform:
+            predictor.predict()
+        mock_transform.assert_called_once()
+    
+    def test_scaler_fitted_only_for_scaled_candidates(self):
+        """Test a round without the linear model skips fitting the scaler"""
+        predictor = self.predictor
+        
+        for candidates, fits in ((['hist_gradient_boost', 'gradient_boost'], 0),
+                                 (['linear', 'gradient_boost'], 1)):
+            with patch.object(predictor, '_candidates', return_value=candidates), \
+                 patch.object(predictor, '_load_unchanged_model', return_value=None), \
+                 patch.object(predictor, '_load_cached_model', return_value=None), \
+                 patch.object(predictor.scaler, 'fit_transform',
+                              side_effect=predictor.scaler.fit_transform) as mock_fit:
+                predictor.train()
+            self.assertEqual(mock_fit.call_count, fits)
+    
+    def test_model_cache_ignores_older_version(self):
+        """Test caches written before the current layout are refitted"""
+        with tempfile.TemporaryDirectory() as cache_dir:
+            first = WaterChangePredictor(self.db, cache_dir=cache_dir)
+            first.train()
+            path = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+            joblib.dump(dict(first._cache_state, version=1), path)
+            
+            second = WaterChangePredictor(self.db, cache_dir=cache_dir)
+            self.assertNotIn('cached', second.train())
+    
+    def test_unchanged_fingerprint_skips_history_fetch(self):
+        """Test a matching history fingerprint reuses the fit without fetching rows"""
+        self.db.get_water_change_history.reset_mock()
+        
+        result = self.predictor.train()
+        
+        self.assertTrue(result['cached'])
+        self.db.get_water_change_history.assert_not_called()
+        
+        # A newly logged water change invalidates the fingerprint
+        self.db.get_training_fingerprint.return_value = (16, 16, None)
+        try:
+            result = self.predictor.train()
+        finally:
+            self.db.get_training_fingerprint.return_value = (15, 15, None)
+        
+        self.assertNotIn('cached', result)
+        self.db.get_water_change_history.assert_called_once()
+    
+    def test_refit_trains_champion_and_one_challenger(self):
+        """Test refits between bake-offs fit only the champion and a rotating challenger"""
+        champion = self.predictor.best_model_name
+        challengers = []
+        try:
+            for count in (16, 17):
+                self.db.get_training_fingerprint.return_value = (count, count, None)
+                result = self.predictor.train()
+                self.assertEqual(len(result['all_scores']), 2)
+                self.assertIn(champion, result['all_scores'])
+                challengers.extend(set(result['all_scores']) - {champion})
+        finally:
+            self.db.get_training_fingerprint.return_value = (15, 15, None)
+        
+        # Both other models got a turn, and the unchanged data kept the champion
+        self.assertEqual(set(challengers), set(self.predictor.models) - {champion})
+        self.assertEqual(self.predictor.best_model_name, champion)
+    
+    def test_retrain_threshold(self):
+        """Test early retraining waits for 20% new events relative to the fit"""
+        self.assertEqual(self.predictor.samples_at_last_train, len(self.history) - 1)
+        
+        self.predictor.note_new_events(2)
+        self.assertFalse(self.predictor.enough_new_data())
+        self.predictor.note_new_events()
+        self.assertTrue(self.predictor.enough_new_data())
+        
+        self.predictor.train()
+        self.assertFalse(self.predictor.enough_new_data())
+    
+    def test_events_logged_during_training_are_kept(self):
+        """Test events noted while train() runs count towards the next retrain"""
+        fingerprint = self.db.get_training_fingerprint.return_value
+        
+        def note_during_train():
+            self.predictor.note_new_events(3)
+            return fingerprint
+        self.db.get_training_fingerprint.side_effect = note_during_train
+        try:
+            self.predictor.train()
+        finally:
+            self.db.get_training_fingerprint.side_effect = None
+        
+        self.assertEqual(self.predictor.new_events, 3)
+    
+    def test_retrain_threshold_wakes_service(self):
+        """Test reaching the retrain threshold wakes the service loop"""
+        with patch('aquarium_ml_service.service_wakeup') as wakeup:
+            self.predictor.note_new_events(2)
+            wakeup.set.assert_not_called()
+            self.predictor.note_new_events()
+            wakeup.set.assert_called_once()
+    
+    def test_copy_isolated_from_shared_predictor(self):
+        """Test mutating a per-test copy leaves the shared trained predictor intact"""
+        self.predictor.best_model = None
+        
+        self.assertEqual(self.predictor.predict()['error'], 'no_model')
+        self.assertIsNotNone(self.trained_predictor.best_model)
+
+
 class TestMQTTIntegration(unittest.TestCase):
     """Test MQTT integration"""
     
@@ -269,9 +892,9 @@ class TestMQTTIntegration(unittest.TestCase):
         mock_mqtt_client.return_value = self.mock_mqtt
         
         self.db = AquariumDatabase('localhost', 3306, 'test', 'test', 'test')
-        self.pid_temp = PIDOptimizer(self.db, 'temp')
-        self.pid_co2 = PIDOptimizer(self.db, 'co2')
-        self.wc_predictor = WaterChangePredictor(self.db)
+        self.pid_temp = PIDOptimizer(self.db, 'temp', cache_dir=None)
+        self.pid_co2 = PIDOptimizer(self.db, 'co2', cache_dir=None)
+        self.wc_predictor = WaterChangePredictor(self.db, cache_dir=None)
         
         self.mqtt_manager = MQTTManager(
             self.db,
@@ -279,6 +902,22 @@ class TestMQTTIntegration(unittest.TestCase):
             self.wc_predictor
         )
     
+    def test_on_connect_subscribes_once_and_reports_online(self):
+        """Test all topics go in one QoS 0 SUBSCRIBE and the retained status flips online"""
+        self.mock_mqtt.will_set.assert_called_once()
+        self.assertEqual(json.loads(self.mock_mqtt.will_set.call_args[0][1]), {'state': 'offline'})
+        
+        self.mqtt_manager.on_connect(self.mock_mqtt, None, {}, 0)
+        
+        self.mock_mqtt.subscribe.assert_called_once()
+        subscriptions = self.mock_mqtt.subscribe.call_args[0][0]
+        self.assertEqual(len(subscriptions), 5)
+        self.assertTrue(all(qos == 0 for _, qos in subscriptions))
+        topic, payload = self.mock_mqtt.publish.call_args[0]
+        self.assertTrue(topic.endswith('/ml/status'))
+        self.assertEqual(json.loads(payload), {'state': 'online'})
+        self.assertTrue(self.mock_mqtt.publish.call_args[1]['retain'])
+    
     def test_publish_pid_gains(self):
         """Test publishing PID gains"""
         gains = {
@@ -325,6 +964,55 @@ class TestMQTTIntegration(unittest.TestCase):
         
         self.assertTrue(success)
         self.mock_mqtt.publish.assert_called_once()
+        
+        # Retained forecast carries an MQTT 5 expiry so it cannot go stale
+        properties = self.mock_mqtt.publish.call_args[1]['properties']
+        self.assertEqual(properties.MessageExpiryInterval, 48 * 3600)
+    
+    def test_publish_waits_for_background_connect(self):
+        """Test the first publish after connect(background=True) waits for CONNACK"""
+        result_mock = Mock()
+        result_mock.rc = 0
+        self.mock_mqtt.publish.return_value = result_mock
+        self.mqtt_manager.connect(background=True)
+        self.mqtt_manager.wait_for_connection = Mock(return_value=True)
+        
+        self.mqtt_manager.publish_wc_prediction({'predicted_days_remaining': 3.5})
+        self.mqtt_manager.publish_wc_prediction({'predicted_days_remaining': 3.5})
+        
+        self.mock_mqtt.connect_async.assert_called_once()
+        self.mqtt_manager.wait_for_connection.assert_called_once()
+        self.assertEqual(self.mock_mqtt.publish.call_count, 2)
+    
+    def test_publish_serialises_numpy_scalars(self):
+        """Test payloads accept NumPy scalars and are compact with and without orjson"""
+        prediction = {
+            'predicted_days_remaining': np.float64(3.5),
+            'confidence': np.float32(0.5),
+            'needs_change_soon': np.bool_(True),
+            'timestamp': np.int64(1700000000),
+            'model_type': None
+        }
+        result_mock = Mock()
+        result_mock.rc = 0
+        self.mock_mqtt.publish.return_value = result_mock
+        
+        def assert_round_trip():
+            self.mock_mqtt.publish.reset_mock()
+            self.assertTrue(self.mqtt_manager.publish_wc_prediction(prediction))
+            payload = self.mock_mqtt.publish.call_args[0][1]
+            self.assertIsInstance(payload, bytes)
+            self.assertNotIn(b' ', payload)
+            self.assertEqual(json.loads(payload), {
+                'predicted_days_remaining': 3.5,
+                'confidence': 0.5,
+                'needs_change_soon': True,
+                'timestamp': 1700000000
+            })
+        
+        assert_round_trip()
+        with patch('aquarium_ml_service.orjson', None):
+            assert_round_trip()
     
     def test_on_message_sensor_data(self):
         """Test handling sensor data message"""
@@ -343,6 +1031,7 @@ class TestMQTTIntegration(unittest.TestCase):
         msg.payload = payload.encode()
         
         self.mqtt_manager.on_message(None, None, msg)
+        self.mqtt_manager.drain()
         
         # Verify sensor reading was stored
         self.mock_cursor.execute.assert_called()
@@ -372,9 +1061,61 @@ class TestMQTTIntegration(unittest.TestCase):
         msg.payload = payload.encode()
         
         self.mqtt_manager.on_message(None, None, msg)
+        self.mqtt_manager.drain()
         
         # Verify performance data was stored
         self.mock_cursor.execute.assert_called()
+    
+    def test_on_message_stores_off_network_thread(self):
+        """Test messages are written by the DB writer thread, not paho's callback thread"""
+        threads = []
+        msg = Mock()
+        msg.topic = 'aquarium/pid/performance'
+        msg.payload = json.dumps({'controller': 'temp', 'kp': 10.0, 'ki': 0.5, 'kd': 5.0}).encode()
+        
+        with patch.object(self.db, 'store_pid_performance',
+                          side_effect=lambda data: threads.append(threading.current_thread())):
+            self.mqtt_manager.on_message(None, None, msg)
+            self.mqtt_manager.drain()
+        
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.current_thread())
+    
+    def test_on_message_never_raises(self):
+        """Test undecodable payloads and a shut-down writer are logged, not raised"""
+        msg = Mock()
+        msg.topic = 'aquarium/data'
+        
+        with patch('aquarium_ml_service.orjson', None):
+            msg.payload = b'\xff\xfe'
+            self.mqtt_manager.on_message(None, None, msg)
+        
+        msg.payload = b'{"temperature": 24.5}'
+        self.mqtt_manager._db_writer.shutdown()
+        self.mqtt_manager.on_message(None, None, msg)
+    
+    def test_on_message_wc_history(self):
+        """Test a history list is stored with one executemany, skipping known events"""
+        now = int(time.time())
+        history = [
+            {'startTime': now - i * 7 * 86400 - 3600, 'endTime': now - i * 7 * 86400,
+             'volume': 40.0, 'tdsBefore': 320.0, 'tdsAfter': 210.0, 'successful': True}
+            for i in range(5)
+        ]
+        self.mock_cursor.fetchall.return_value = [(now,)]  # newest already stored
+        self.mock_cursor.rowcount = 4
+        
+        msg = Mock()
+        msg.topic = 'aquarium/waterchange/history'
+        msg.payload = json.dumps(history).encode()
+        
+        self.mqtt_manager.on_message(None, None, msg)
+        self.mqtt_manager.drain()
+        
+        self.mock_cursor.executemany.assert_called_once()
+        sql, params = self.mock_cursor.executemany.call_args[0]
+        self.assertIn('INSERT INTO water_changes', sql)
+        self.assertEqual([row[1] for row in params], [h['endTime'] for h in history[1:]])
 
 
 class TestEndToEndIntegration(unittest.TestCase):
@@ -390,39 +1131,31 @@ class TestEndToEndIntegration(unittest.TestCase):
         mock_conn.cursor.return_value = mock_cursor
         mock_connect.return_value = mock_conn
         
-        # Mock PID performance history
-        history = []
-        for i in range(60):
-            history.append((
-                i + 1,  # id
-                int(time.time()) - (i * 3600),  # timestamp
-                'temp',  # controller
-                10.0 + np.random.randn() * 0.5,  # kp
-                0.5 + np.random.randn() * 0.05,  # ki
-                5.0 + np.random.randn() * 0.3,  # kd
-                12.0 + np.random.randn() * 2.0,  # settling_time
-                0.3 + np.random.randn() * 0.1,  # overshoot
-                0.05,  # steady_state_error
-                24.5,  # temperature
-                22.0,  # ambient_temp
-                300.0,  # tds
-                7.2,  # ph
-                14,  # hour
-                1,  # season (summer)
-                200.0  # tank_volume
-            ))
-        
-        mock_cursor.fetchall.return_value = history
-        mock_cursor.description = [
-            ('id',), ('timestamp',), ('controller',), ('kp',), ('ki',), ('kd',),
-            ('settling_time',), ('overshoot',), ('steady_state_error',),
-            ('temperature',), ('ambient_temp',), ('tds',), ('ph',),
-            ('hour',), ('season',), ('tank_volume',)
-        ]
+        # Mock PID performance history, one NumPy column per selected field
+        n = 60
+        history = list(zip(
+            (int(time.time()) - np.arange(n) * 3600).tolist(),  # timestamp
+            (10.0 + np.random.randn(n) * 0.5).tolist(),  # kp
+            (0.5 + np.random.randn(n) * 0.05).tolist(),  # ki
+            (5.0 + np.random.randn(n) * 0.3).tolist(),  # kd
+            (12.0 + np.random.randn(n) * 2.0).tolist(),  # settling_time
+            (0.3 + np.random.randn(n) * 0.1).tolist(),  # overshoot
+            [24.5] * n,  # temperature
+            [22.0] * n,  # ambient_temp
+            [300.0] * n,  # tds
+            [7.2] * n,  # ph
+            [14] * n,  # hour
+            [200.0] * n  # tank_volume
+        ))
+        
+        mock_cursor.fetchmany.side_effect = [history[:40], history[40:], []]
+        mock_cursor.fetchone.return_value = (n, n)  # pid_performance fingerprint
         
         # Create optimizer
         db = AquariumDatabase('localhost', 3306, 'test', 'test', 'test')
-        optimizer = PIDOptimizer(db, 'temp')
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        optimizer = PIDOptimizer(db, 'temp', cache_dir=cache_dir)
         
         # Train
         result = optimizer.train_season(1)  # Summer
@@ -451,10 +1184,119 @@ class TestEndToEndIntegration(unittest.TestCase):
         self.assertGreater(prediction['kp'], 0)
         self.assertGreater(prediction['ki'], 0)
         self.assertGreater(prediction['kd'], 0)
-
+        
+        # Confidence reflects the season's training fit
+        self.assertAlmostEqual(prediction['confidence'], max(0.0, min(1.0, result['avg_score'])))
+        
+        # A restart with unchanged history loads the saved models without fetching rows
+        restarted = PIDOptimizer(db, 'temp', cache_dir=cache_dir)
+        mock_cursor.fetchmany.reset_mock()
+        self.assertTrue(restarted.train_season(1)['cached'])
+        mock_cursor.fetchmany.assert_not_called()
+        self.assertEqual(restarted.predict(sensor_data, season=1)['kp'], prediction['kp'])
+    
+    @patch('aquarium_ml_service.mysql.connector.connect')
+    @patch('aquarium_ml_service.mqtt.Client')
+    def test_run_once_uses_single_mqtt_session(self, mock_mqtt_client, mock_connect):
+        """Test --once publishes over one MQTT session and flushes it before stopping"""
+        mock_connect.return_value = Mock()
+        mock_mqtt = mock_mqtt_client.return_value
+        
+        service = AquariumMLService(cache_dir=None)
+        service.mqtt.connected = True
+        service.train_all_pid_models = Mock()
+        service.train_wc_model = Mock()
+        
+        service.run_once()
+        
+        # Handshake runs on the network thread while training proceeds
+        mock_mqtt.connect_async.assert_called_once()
+        mock_mqtt.connect.assert_not_called()
+        service.train_all_pid_models.assert_called_once()
+        service.train_wc_model.assert_called_once()
+        
+        # Disconnect is queued before the network loop stops so publishes drain
+        calls = [name for name, _, _ in mock_mqtt.mock_calls]
+        self.assertLess(calls.index('disconnect'), calls.index('loop_stop'))
+    
+    @patch('aquarium_ml_service.mysql.connector.connect')
+    @patch('aquarium_ml_service.mqtt.Client')
+    def test_mqtt_writer_has_its_own_connection(self, mock_mqtt_client, mock_connect):
+        """Test MQTT messages are stored over a connection training never uses"""
+        mock_connect.side_effect = lambda **config: Mock()
+        
+        service = AquariumMLService(cache_dir=None)
+        
+        self.assertEqual(mock_connect.call_count, 2)
+        self.assertIs(service.mqtt.db, service.mqtt_db)
+        self.assertIsNot(service.mqtt_db.conn, service.db.conn)
+        # Only the first instance runs the schema DDL
+        service.mqtt_db.conn.cursor.assert_not_called()
+    
+    @patch('aquarium_ml_service.mysql.connector.connect')
+    @patch('aquarium_ml_service.mqtt.Client')
+    def test_predictions_see_readings_buffered_on_writer(self, mock_mqtt_client, mock_connect):
+        """Test buffered MQTT readings are flushed on the writer thread before averaging"""
+        mock_connect.side_effect = lambda **config: Mock()
+        service = AquariumMLService(cache_dir=None)
+        order = []
+        
+        def flush():
+            order.append(('flush', threading.current_thread().name))
+            return 0
+        service.mqtt_db.flush_sensor_readings = flush
+        service.db.get_sensor_averages = Mock(
+            side_effect=lambda hours: order.append(('averages', None)) or {'count': 0})
+        
+        service.publish_pid_predictions(season=1)
+        service.mqtt.disconnect()
+        
+        self.assertEqual(order[1], ('averages', None))
+        self.assertEqual(order[0][0], 'flush')
+        self.assertTrue(order[0][1].startswith('mqtt-db'))
+    
+    @patch('aquarium_ml_service.mysql.connector.connect')
+    @patch('aquarium_ml_service.mqtt.Client')
+    def test_wc_prediction_stored_regardless_of_publish(self, mock_mqtt_client, mock_connect):
+        """Test the WC prediction is committed on its own and a failed publish is only logged"""
+        mock_conn = Mock()
+        mock_conn.cursor.return_value.rowcount = 1
+        mock_connect.return_value = mock_conn
+        
+        service = AquariumMLService(cache_dir=None)
+        service.wc_predictor.train = Mock(return_value={'model': 'linear'})
+        service.wc_predictor.predict = Mock(return_value={
+            'predicted_days_remaining': 3.5, 'confidence': 0.8, 'model': 'linear'
+        })
+        
+        for published in (True, False):
+            mock_conn.commit.reset_mock()
+            mock_conn.start_transaction.reset_mock()
+            service.mqtt.publish_wc_prediction = Mock(return_value=published)
+            
+            with patch('aquarium_ml_service.logger') as mock_logger:
+                service.train_wc_model()
+            
+            mock_conn.commit.assert_called_once()
+            mock_conn.start_transaction.assert_not_called()
+            mock_conn.rollback.assert_not_called()
+            self.assertEqual(mock_logger.warning.called, not published)
 
 def run_tests():
-    """Run all tests"""
+    """Run all tests
+    
+    With pytest-xdist installed the test classes are spread across all CPU
+    cores (--dist=loadscope keeps each class, and its setUpClass fixtures, on
+    one worker); otherwise the suite runs serially under unittest.
+    """
+    try:
+        import pytest
+        import xdist  # noqa: F401
+    except ImportError:
+        pass
+    else:
+        return int(pytest.main([__file__, '-n', 'auto', '--dist=loadscope', '-q']))
+    
     # Create test suite
     loader = unittest.TestLoader()
     suite = unittest.TestSuite()
@@ -463,6 +1305,7 @@ def run_tests():
     suite.addTests(loader.loadTestsFromTestCase(TestAquariumDatabase))
     suite.addTests(loader.loadTestsFromTestCase(TestPIDOptimizer))
     suite.addTests(loader.loadTestsFromTestCase(TestWaterChangePredictor))
+    suite.addTests(loader.loadTestsFromTestCase(TestWaterChangePredictorTrained))
     suite.addTests(loader.loadTestsFromTestCase(TestMQTTIntegration))
     suite.addTests(loader.loadTestsFromTestCase(TestEndToEndIntegration))
     
@@ -22,9 +22,12 @@ Usage:
 
 import json
 import os
+import shutil
 import sys
+import tempfile
 import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 import numpy as np
@@ -54,64 +57,154 @@ TEST_MQTT_PORT = int(os.environ.get('TEST_MQTT_PORT', 1883))
 TEST_MQTT_USER = os.environ.get('TEST_MQTT_USER', '')
 TEST_MQTT_PASSWORD = os.environ.get('TEST_MQTT_PASSWORD', '')
 
+# Synthetic sensor rows per bulk test; raise for stress runs (e.g. 1000000)
+TEST_SENSOR_ROWS = int(os.environ.get('TEST_SENSOR_ROWS', 100))
 
-class TestDatabaseIntegration(unittest.TestCase):
-    """Integration tests for database operations"""
+
+TEST_TABLES = (
+    'sensor_readings',
+    'pid_performance',
+    'pid_gains',
+    'water_changes',
+    'filter_maintenance',
+    'wc_predictions'
+)
+
+
+def cleanup_tables(db):
+    """Empty every service table, keeping the schema
     
-    @classmethod
-    def setUpClass(cls):
-        """Set up test database"""
+    TRUNCATE drops and recreates the InnoDB tablespace instead of writing
+    per-row undo like DELETE, and resets AUTO_INCREMENT counters.
+    """
+    cursor = db.conn.cursor()
+    try:
+        cursor.execute("SET FOREIGN_KEY_CHECKS=0")
+        for table in TEST_TABLES:
+            cursor.execute(f"TRUNCATE TABLE {table}")
+        cursor.execute("SET FOREIGN_KEY_CHECKS=1")
+    finally:
+        cursor.close()
+
+
+# Progress lines are collected and written once at the end of the run
+_output = []
+
+
+def log(message: str = ''):
+    """Queue a progress line for the end-of-run report"""
+    _output.append(message)
+
+
+def flush_log():
+    """Write all queued progress lines in a single write"""
+    if _output:
+        sys.stdout.write('\n'.join(_output) + '\n')
+        sys.stdout.flush()
+        _output.clear()
+
+
+def generate_sensor_rows(n, base_time):
+    """Build n synthetic sensor rows in sensor_readings column order
+    
+    Every column is computed as a whole NumPy array and converted to Python
+    scalars in one tolist() per column, so generation stays cheap even at
+    millions of rows.
+    """
+    idx = np.arange(n)
+    return list(zip(
+        (base_time - idx * 300).tolist(),       # timestamp
+        (25.5 + idx * 0.01).tolist(),           # temperature
+        np.full(n, 22.3).tolist(),              # ambient_temp
+        (6.8 + idx * 0.001).tolist(),           # ph
+        (300 + idx * 0.5).tolist(),             # tds
+        (idx % 2 == 0).astype(int).tolist(),    # heater_state
+        np.ones(n, dtype=int).tolist()          # co2_state
+    ))
+
+
+_test_db = None
+_test_db_error = None
+
+
+def get_test_database():
+    """Return the test database connection shared by every test class
+    
+    The connection and schema setup happen once per run instead of once per
+    class; tearDownModule empties the tables and closes it. A failed first
+    connection is remembered and re-raised, so when the database is down
+    every later class skips immediately instead of retrying it.
+    """
+    global _test_db, _test_db_error
+    if _test_db_error is not None:
+        raise _test_db_error
+    if _test_db is None:
         try:
-            cls.db = AquariumDatabase(
+            _test_db = AquariumDatabase(
                 TEST_DB_HOST,
                 TEST_DB_PORT,
                 TEST_DB_NAME,
                 TEST_DB_USER,
-                TEST_DB_PASSWORD
+                TEST_DB_PASSWORD,
+                allow_local_infile=True
             )
-            print(f"\n✓ Connected to test database: {TEST_DB_NAME}")
+        except Exception as e:
+            _test_db_error = e
+            raise
+    return _test_db
+
+
+def tearDownModule():
+    """Clean up the shared test database"""
+    global _test_db
+    if _test_db is not None and _test_db.conn:
+        try:
+            cleanup_tables(_test_db)
+            log("\n✓ Cleaned up test database")
+        finally:
+            _test_db.conn.close()
+            _test_db = None
+    flush_log()
+
+
+class TestDatabaseIntegration(unittest.TestCase):
+    """Integration tests for database operations"""
+    
+    @classmethod
+    def setUpClass(cls):
+        """Set up test database"""
+        try:
+            cls.db = get_test_database()
+            # One buffered cursor shared by every verification query in the class
+            cls.cursor = cls.db.conn.cursor(buffered=True)
+            log(f"\n✓ Connected to test database: {TEST_DB_NAME}")
         except Exception as e:
             raise unittest.SkipTest(f"Cannot connect to test database: {e}")
     
     @classmethod
     def tearDownClass(cls):
-        """Clean up test database"""
-        if hasattr(cls, 'db') and cls.db.conn:
-            # Drop all tables
-            cursor = cls.db.conn.cursor()
-            try:
-                cursor.execute("DROP TABLE IF EXISTS sensor_readings")
-                cursor.execute("DROP TABLE IF EXISTS pid_performance")
-                cursor.execute("DROP TABLE IF EXISTS pid_gains")
-                cursor.execute("DROP TABLE IF EXISTS water_changes")
-                cursor.execute("DROP TABLE IF EXISTS filter_maintenance")
-                cursor.execute("DROP TABLE IF EXISTS wc_predictions")
-                cls.db.conn.commit()
-                print("\n✓ Cleaned up test database")
-            finally:
-                cursor.close()
-                cls.db.conn.close()
+        """Release the shared verification cursor"""
+        if hasattr(cls, 'cursor'):
+            cls.cursor.close()
+    
+    def setUp(self):
+        """Run each test inside a transaction"""
+        self.db.begin()
+    
+    def tearDown(self):
+        """Roll back the test's inserts instead of deleting them"""
+        self.db.rollback()
     
     def test_01_table_creation(self):
         """Test that all tables are created"""
-        cursor = self.db.conn.cursor()
+        cursor = self.cursor
         cursor.execute("SHOW TABLES")
         tables = [row[0] for row in cursor.fetchall()]
-        cursor.close()
-        
-        expected_tables = [
-            'sensor_readings',
-            'pid_performance',
-            'pid_gains',
-            'water_changes',
-            'filter_maintenance',
-            'wc_predictions'
-        ]
         
-        for table in expected_tables:
+        for table in TEST_TABLES:
             self.assertIn(table, tables, f"Table {table} not created")
         
-        print(f"✓ All {len(expected_tables)} tables created")
+        log(f"✓ All {len(TEST_TABLES)} tables created")
     
     def test_02_store_and_retrieve_sensor_data(self):
         """Test storing and retrieving sensor readings"""
@@ -127,12 +220,12 @@ class TestDatabaseIntegration(unittest.TestCase):
         }
         
         self.db.store_sensor_reading(test_data)
+        self.db.flush_sensor_readings()  # readings are buffered into batches
         
         # Retrieve it
-        cursor = self.db.conn.cursor()
+        cursor = self.cursor
         cursor.execute("SELECT * FROM sensor_readings ORDER BY id DESC LIMIT 1")
         row = cursor.fetchone()
-        cursor.close()
         
         self.assertIsNotNone(row)
         self.assertEqual(row[2], 24.5)  # temperature
@@ -140,7 +233,7 @@ class TestDatabaseIntegration(unittest.TestCase):
         self.assertEqual(row[4], 7.2)   # ph
         self.assertEqual(row[5], 300.0) # tds
         
-        print(f"✓ Stored and retrieved sensor reading: temp={row[2]}°C")
+        log(f"✓ Stored and retrieved sensor reading: temp={row[2]}°C")
     
     def test_03_store_pid_performance(self):
         """Test storing PID performance data"""
@@ -165,17 +258,16 @@ class TestDatabaseIntegration(unittest.TestCase):
         self.db.store_pid_performance(test_data)
         
         # Retrieve it
-        cursor = self.db.conn.cursor()
+        cursor = self.cursor
         cursor.execute("SELECT * FROM pid_performance WHERE controller='temp' ORDER BY id DESC LIMIT 1")
         row = cursor.fetchone()
-        cursor.close()
         
         self.assertIsNotNone(row)
         self.assertEqual(row[3], 10.0)  # kp
         self.assertEqual(row[4], 0.5)   # ki
         self.assertEqual(row[5], 5.0)   # kd
         
-        print(f"✓ Stored PID performance: Kp={row[3]}, Ki={row[4]}, Kd={row[5]}")
+        log(f"✓ Stored PID performance: Kp={row[3]}, Ki={row[4]}, Kd={row[5]}")
     
     def test_04_store_water_change(self):
         """Test storing water change event"""
@@ -197,17 +289,80 @@ class TestDatabaseIntegration(unittest.TestCase):
         self.db.store_water_change(test_data)
         
         # Retrieve it
-        cursor = self.db.conn.cursor()
+        cursor = self.cursor
         cursor.execute("SELECT * FROM water_changes ORDER BY id DESC LIMIT 1")
         row = cursor.fetchone()
-        cursor.close()
         
         self.assertIsNotNone(row)
         self.assertEqual(row[3], 40.0)   # volume
         self.assertEqual(row[7], 320.0)  # tds_before
         self.assertEqual(row[8], 210.0)  # tds_after
         
-        print(f"✓ Stored water change: {row[3]}L, TDS {row[7]}→{row[8]} ppm")
+        log(f"✓ Stored water change: {row[3]}L, TDS {row[7]}→{row[8]} ppm")
+    
+    def test_05_store_wc_predictions(self):
+        """Test storing water change predictions through the bulk path"""
+        inserted = self.db.store_wc_predictions_bulk([(3.5, 0.82, 'gradient_boost')])
+        self.assertEqual(inserted, 1)
+        
+        cursor = self.cursor
+        cursor.execute("SELECT predicted_days, confidence, model_type FROM wc_predictions ORDER BY id DESC LIMIT 1")
+        row = cursor.fetchone()
+        
+        self.assertIsNotNone(row)
+        self.assertAlmostEqual(row[0], 3.5, places=3)
+        self.assertEqual(row[2], 'gradient_boost')
+        
+        log(f"✓ Stored WC prediction: {row[0]} days ({row[2]})")
+    
+    def test_06_store_sensor_readings_bulk(self):
+        """Test bulk storing synthetic sensor history built from NumPy columns"""
+        n = TEST_SENSOR_ROWS
+        rows = generate_sensor_rows(n, int(time.time()))
+        
+        inserted = self.db.store_sensor_readings_bulk(rows)
+        self.assertEqual(inserted, n)
+        
+        # Verify against the in-memory batch: one indexed COUNT over its time
+        # range plus a single projected spot check, instead of materialising
+        # every reading back into dicts
+        cursor = self.cursor
+        cursor.execute(
+            "SELECT COUNT(*) FROM sensor_readings WHERE timestamp BETWEEN %s AND %s",
+            (rows[-1][0], rows[0][0])
+        )
+        self.assertGreaterEqual(cursor.fetchone()[0], n)
+        
+        cursor.execute(
+            "SELECT temperature, heater_state FROM sensor_readings WHERE timestamp = %s LIMIT 1",
+            (rows[0][0],)
+        )
+        temperature, heater_state = cursor.fetchone()
+        self.assertAlmostEqual(temperature, rows[0][1], places=3)
+        self.assertEqual(heater_state, rows[0][5])
+        
+        log(f"✓ Bulk stored {inserted} sensor readings")
+    
+    def test_07_load_sensor_readings_csv(self):
+        """Test streaming sensor history through LOAD DATA LOCAL INFILE"""
+        n = TEST_SENSOR_ROWS
+        rows = generate_sensor_rows(n, int(time.time()))
+        
+        loaded = self.db.load_csv(
+            'sensor_readings',
+            ['timestamp', 'temperature', 'ambient_temp', 'ph', 'tds', 'heater_state', 'co2_state'],
+            rows
+        )
+        self.assertEqual(loaded, n)
+        
+        cursor = self.cursor
+        cursor.execute(
+            "SELECT COUNT(*) FROM sensor_readings WHERE timestamp BETWEEN %s AND %s",
+            (rows[-1][0], rows[0][0])
+        )
+        self.assertEqual(cursor.fetchone()[0], n)
+        
+        log(f"✓ Loaded {loaded} sensor readings from CSV")
 
 
 class TestPIDOptimizerIntegration(unittest.TestCase):
@@ -217,15 +372,12 @@ class TestPIDOptimizerIntegration(unittest.TestCase):
     def setUpClass(cls):
         """Set up database and optimizer"""
         try:
-            cls.db = AquariumDatabase(
-                TEST_DB_HOST,
-                TEST_DB_PORT,
-                TEST_DB_NAME,
-                TEST_DB_USER,
-                TEST_DB_PASSWORD
-            )
-            cls.optimizer = PIDOptimizer(cls.db, 'temp')
-            print(f"\n✓ Created PID optimizer for temperature controller")
+            cls.db = get_test_database()
+            # Never read or replace the live service's season model caches
+            cls.cache_dir = tempfile.mkdtemp(prefix='aquarium-ml-test-')
+            cls.addClassCleanup(shutil.rmtree, cls.cache_dir, ignore_errors=True)
+            cls.optimizer = PIDOptimizer(cls.db, 'temp', cache_dir=cls.cache_dir)
+            log(f"\n✓ Created PID optimizer for temperature controller")
         except Exception as e:
             raise unittest.SkipTest(f"Cannot connect to test database: {e}")
     
@@ -234,61 +386,63 @@ class TestPIDOptimizerIntegration(unittest.TestCase):
         base_ts = int(time.time())
         
         # Generate 100 performance records with realistic variations
-        for i in range(100):
-            # Vary conditions throughout the day and seasons
-            hour = (i * 3) % 24
-            season = i % 4  # 0=spring, 1=summer, 2=autumn, 3=winter
-            
-            # Temperature varies by season and time of day
-            if season == 1:  # Summer
-                temp = 25.0 + np.random.randn() * 0.5
-                ambient = 23.0 + (hour - 12) * 0.2 + np.random.randn() * 0.3
-            elif season == 3:  # Winter
-                temp = 23.5 + np.random.randn() * 0.5
-                ambient = 20.0 + (hour - 12) * 0.2 + np.random.randn() * 0.3
-            else:  # Spring/Autumn
-                temp = 24.5 + np.random.randn() * 0.5
-                ambient = 22.0 + (hour - 12) * 0.2 + np.random.randn() * 0.3
-            
-            # TDS slowly increases between water changes
-            days_since_wc = (i % 14) / 14.0  # Reset every 14 days
-            tds = 250.0 + days_since_wc * 80.0 + np.random.randn() * 10
-            
-            # pH varies slightly
-            ph = 7.2 + np.random.randn() * 0.1
-            
-            # Gains vary with performance
-            base_kp = 10.0 if season in [0, 2] else 11.0  # Higher in summer/winter
-            kp = base_kp + np.random.randn() * 1.0
-            ki = 0.5 + np.random.randn() * 0.1
-            kd = 5.0 + np.random.randn() * 0.5
-            
-            # Performance metrics - better gains = better performance
-            settling_time = 12.0 + np.random.randn() * 2.0 + (abs(kp - base_kp) * 2)
-            overshoot = 0.3 + np.random.randn() * 0.1 + (abs(kp - base_kp) * 0.05)
-            steady_state_error = 0.05 + np.random.randn() * 0.01
-            
-            data = {
-                'timestamp': base_ts - (i * 3600),
-                'controller': 'temp',
-                'kp': kp,
-                'ki': ki,
-                'kd': kd,
-                'settling_time': settling_time,
-                'overshoot': overshoot,
-                'steady_state_error': steady_state_error,
-                'temperature': temp,
-                'ambient_temp': ambient,
-                'tds': tds,
-                'ph': ph,
-                'hour': hour,
-                'season': season,
-                'tank_volume': 200.0
-            }
-            
-            self.db.store_pid_performance(data)
-        
-        print(f"✓ Populated 100 training samples")
+        # inside one transaction so the batch costs a single commit
+        with self.db.transaction():
+            for i in range(100):
+                # Vary conditions throughout the day and seasons
+                hour = (i * 3) % 24
+                season = i % 4  # 0=spring, 1=summer, 2=autumn, 3=winter
+                
+                # Temperature varies by season and time of day
+                if season == 1:  # Summer
+                    temp = 25.0 + np.random.randn() * 0.5
+                    ambient = 23.0 + (hour - 12) * 0.2 + np.random.randn() * 0.3
+                elif season == 3:  # Winter
+                    temp = 23.5 + np.random.randn() * 0.5
+                    ambient = 20.0 + (hour - 12) * 0.2 + np.random.randn() * 0.3
+                else:  # Spring/Autumn
+                    temp = 24.5 + np.random.randn() * 0.5
+                    ambient = 22.0 + (hour - 12) * 0.2 + np.random.randn() * 0.3
+                
+                # TDS slowly increases between water changes
+                days_since_wc = (i % 14) / 14.0  # Reset every 14 days
+                tds = 250.0 + days_since_wc * 80.0 + np.random.randn() * 10
+                
+                # pH varies slightly
+                ph = 7.2 + np.random.randn() * 0.1
+                
+                # Gains vary with performance
+                base_kp = 10.0 if season in [0, 2] else 11.0  # Higher in summer/winter
+                kp = base_kp + np.random.randn() * 1.0
+                ki = 0.5 + np.random.randn() * 0.1
+                kd = 5.0 + np.random.randn() * 0.5
+                
+                # Performance metrics - better gains = better performance
+                settling_time = 12.0 + np.random.randn() * 2.0 + (abs(kp - base_kp) * 2)
+                overshoot = 0.3 + np.random.randn() * 0.1 + (abs(kp - base_kp) * 0.05)
+                steady_state_error = 0.05 + np.random.randn() * 0.01
+                
+                data = {
+                    'timestamp': base_ts - (i * 3600),
+                    'controller': 'temp',
+                    'kp': kp,
+                    'ki': ki,
+                    'kd': kd,
+                    'settling_time': settling_time,
+                    'overshoot': overshoot,
+                    'steady_state_error': steady_state_error,
+                    'temperature': temp,
+                    'ambient_temp': ambient,
+                    'tds': tds,
+                    'ph': ph,
+                    'hour': hour,
+                    'season': season,
+                    'tank_volume': 200.0
+                }
+                
+                self.db.store_pid_performance(data)
+        
+        log(f"✓ Populated 100 training samples")
     
     def test_02_train_seasonal_models(self):
         """Test training models for all seasons"""
@@ -302,7 +456,7 @@ class TestPIDOptimizerIntegration(unittest.TestCase):
             self.assertGreater(result['samples'], 0, f"No samples for {season_names[season]}")
             
             results[season_names[season]] = result
-            print(f"✓ {season_names[season]}: {result['samples']} samples, "
+            log(f"✓ {season_names[season]}: {result['samples']} samples, "
                   f"avg score: {result['avg_score']:.3f}")
         
         # Verify all seasons trained
@@ -327,7 +481,7 @@ class TestPIDOptimizerIntegration(unittest.TestCase):
             self.assertGreater(prediction['ki'], 0)
             self.assertGreater(prediction['kd'], 0)
             
-            print(f"✓ {name}: Kp={prediction['kp']:.2f}, Ki={prediction['ki']:.3f}, Kd={prediction['kd']:.2f}")
+            log(f"✓ {name}: Kp={prediction['kp']:.2f}, Ki={prediction['ki']:.3f}, Kd={prediction['kd']:.2f}")
 
 
 class TestWaterChangePredictorIntegration(unittest.TestCase):
@@ -337,23 +491,36 @@ class TestWaterChangePredictorIntegration(unittest.TestCase):
     def setUpClass(cls):
         """Set up database and predictor"""
         try:
-            cls.db = AquariumDatabase(
+            cls.db = get_test_database()
+            # Second pooled connection so disjoint tables can be written concurrently
+            cls.maintenance_db = AquariumDatabase(
                 TEST_DB_HOST,
                 TEST_DB_PORT,
                 TEST_DB_NAME,
                 TEST_DB_USER,
-                TEST_DB_PASSWORD
+                TEST_DB_PASSWORD,
+                allow_local_infile=True
             )
-            cls.predictor = WaterChangePredictor(cls.db)
-            print(f"\n✓ Created water change predictor")
+            # Never read or replace the live service's model cache
+            cls.cache_dir = tempfile.mkdtemp(prefix='aquarium-ml-test-')
+            cls.addClassCleanup(shutil.rmtree, cls.cache_dir, ignore_errors=True)
+            cls.predictor = WaterChangePredictor(cls.db, cache_dir=cls.cache_dir)
+            log(f"\n✓ Created water change predictor")
         except Exception as e:
             raise unittest.SkipTest(f"Cannot connect to test database: {e}")
     
+    @classmethod
+    def tearDownClass(cls):
+        """Close the maintenance connection"""
+        if hasattr(cls, 'maintenance_db') and cls.maintenance_db.conn:
+            cls.maintenance_db.conn.close()
+    
     def test_01_populate_water_change_history(self):
         """Populate database with water change history"""
         base_ts = int(time.time())
         
         # Generate 20 water changes over ~1 year
+        water_changes = []
         for i in range(20):
             # Water changes every 12-16 days
             days_between = 12 + (i % 5)
@@ -364,7 +531,7 @@ class TestWaterChangePredictorIntegration(unittest.TestCase):
             tds_before = 280 + (i % 14) * 5 + np.random.randn() * 10
             tds_after = 200 + np.random.randn() * 15
             
-            data = {
+            water_changes.append({
                 'startTime': start_ts,
                 'endTime': end_ts,
                 'volume': 40.0,
@@ -376,29 +543,31 @@ class TestWaterChangePredictorIntegration(unittest.TestCase):
                 'tdsAfter': tds_after,
                 'duration': 60,
                 'successful': True
+            })
+        
+        filter_maintenance = [
+            {
+                'timestamp': base_ts - (i * 90 * 86400),  # Every 90 days
+                'filter_type': 'mechanical' if i % 2 == 0 else 'biological',
+                'days_since_last': 90,
+                'tds_before': 310.0,
+                'tds_after': 280.0,
+                'notes': f'Test maintenance {i}'
             }
-            
-            self.db.store_water_change(data)
-        
-        # Add filter maintenance records
-        for i in range(5):
-            cursor = self.db.conn.cursor()
-            cursor.execute("""
-                INSERT INTO filter_maintenance 
-                (timestamp, filter_type, days_since_last, tds_before, tds_after, notes)
-                VALUES (%s, %s, %s, %s, %s, %s)
-            """, (
-                base_ts - (i * 90 * 86400),  # Every 90 days
-                'mechanical' if i % 2 == 0 else 'biological',
-                90,
-                310.0,
-                280.0,
-                f'Test maintenance {i}'
-            ))
-            self.db.conn.commit()
-            cursor.close()
-        
-        print(f"✓ Populated 20 water change events and 5 filter maintenance records")
+            for i in range(5)
+        ]
+        
+        # The two tables are independent, so insert them in parallel on separate
+        # connections; executemany reports the rows inserted, so no COUNT(*) is needed
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            wc_future = executor.submit(self.db.store_water_changes_bulk, water_changes)
+            fm_future = executor.submit(self.maintenance_db.store_filter_maintenance_bulk,
+                                        filter_maintenance)
+        
+        self.assertEqual(wc_future.result(), len(water_changes))
+        self.assertEqual(fm_future.result(), len(filter_maintenance))
+        
+        log(f"✓ Populated 20 water change events and 5 filter maintenance records")
     
     def test_02_train_predictor(self):
         """Test training water change predictor"""
@@ -408,9 +577,9 @@ class TestWaterChangePredictorIntegration(unittest.TestCase):
         self.assertGreater(result['samples'], 0)
         self.assertIn('best_model', result)
         
-        print(f"✓ Trained on {result['samples']} samples")
-        print(f"  Best model: {result['best_model']}")
-        print(f"  Scores: Linear={result['linear_r2']:.3f}, "
+        log(f"✓ Trained on {result['samples']} samples")
+        log(f"  Best model: {result['best_model']}")
+        log(f"  Scores: Linear={result['linear_r2']:.3f}, "
               f"RF={result['rf_r2']:.3f}, GB={result['gb_r2']:.3f}")
     
     def test_03_predict_next_change(self):
@@ -426,6 +595,7 @@ class TestWaterChangePredictorIntegration(unittest.TestCase):
             'co2State': 'OFF'
         }
         self.db.store_sensor_reading(current_data)
+        self.db.flush_sensor_readings()
         
         # Make prediction
         prediction = self.predictor.predict()
@@ -434,11 +604,11 @@ class TestWaterChangePredictorIntegration(unittest.TestCase):
         self.assertGreater(prediction['predicted_days_remaining'], 0)
         self.assertIn('confidence', prediction)
         
-        print(f"✓ Prediction: {prediction['predicted_days_remaining']:.1f} days remaining")
-        print(f"  Confidence: {prediction['confidence']:.2f}")
-        print(f"  TDS: {prediction['current_tds']:.1f} ppm")
-        print(f"  TDS increase rate: {prediction['tds_increase_rate']:.1f} ppm/day")
-        print(f"  Needs change soon: {prediction['needs_change_soon']}")
+        log(f"✓ Prediction: {prediction['predicted_days_remaining']:.1f} days remaining")
+        log(f"  Confidence: {prediction['confidence']:.2f}")
+        log(f"  TDS: {prediction['current_tds']:.1f} ppm")
+        log(f"  TDS increase rate: {prediction['tds_increase_rate']:.1f} ppm/day")
+        log(f"  Needs change soon: {prediction['needs_change_soon']}")
 
 
 class TestMQTTIntegration(unittest.TestCase):
@@ -449,18 +619,14 @@ class TestMQTTIntegration(unittest.TestCase):
         """Set up MQTT client and database"""
         try:
             # Database
-            cls.db = AquariumDatabase(
-                TEST_DB_HOST,
-                TEST_DB_PORT,
-                TEST_DB_NAME,
-                TEST_DB_USER,
-                TEST_DB_PASSWORD
-            )
+            cls.db = get_test_database()
             
             # ML components
-            cls.pid_temp = PIDOptimizer(cls.db, 'temp')
-            cls.pid_co2 = PIDOptimizer(cls.db, 'co2')
-            cls.wc_predictor = WaterChangePredictor(cls.db)
+            cls.cache_dir = tempfile.mkdtemp(prefix='aquarium-ml-test-')
+            cls.addClassCleanup(shutil.rmtree, cls.cache_dir, ignore_errors=True)
+            cls.pid_temp = PIDOptimizer(cls.db, 'temp', cache_dir=cls.cache_dir)
+            cls.pid_co2 = PIDOptimizer(cls.db, 'co2', cache_dir=cls.cache_dir)
+            cls.wc_predictor = WaterChangePredictor(cls.db, cache_dir=cls.cache_dir)
             
             # MQTT manager
             cls.mqtt_manager = MQTTManager(
@@ -495,7 +661,7 @@ class TestMQTTIntegration(unittest.TestCase):
             cls.mqtt_manager.connect()
             time.sleep(2)  # Allow connections to establish
             
-            print(f"\n✓ Connected to MQTT broker: {TEST_MQTT_BROKER}:{TEST_MQTT_PORT}")
+            log(f"\n✓ Connected to MQTT broker: {TEST_MQTT_BROKER}:{TEST_MQTT_PORT}")
             
         except Exception as e:
             raise unittest.SkipTest(f"Cannot connect to MQTT broker: {e}")
@@ -509,7 +675,7 @@ class TestMQTTIntegration(unittest.TestCase):
         if hasattr(cls, 'mqtt_manager'):
             cls.mqtt_manager.client.loop_stop()
             cls.mqtt_manager.client.disconnect()
-        print("\n✓ Disconnected from MQTT broker")
+        log("\n✓ Disconnected from MQTT broker")
     
     def setUp(self):
         """Clear received messages before each test"""
@@ -542,7 +708,7 @@ class TestMQTTIntegration(unittest.TestCase):
         self.assertIsNotNone(row)
         self.assertEqual(row[2], 24.5)  # temperature
         
-        print(f"✓ Sensor data published and stored: temp={row[2]}°C, TDS={row[5]} ppm")
+        log(f"✓ Sensor data published and stored: temp={row[2]}°C, TDS={row[5]} ppm")
     
     def test_02_publish_pid_gains(self):
         """Test publishing PID gains"""
@@ -571,7 +737,7 @@ class TestMQTTIntegration(unittest.TestCase):
         self.assertEqual(msg['payload']['controller'], 'temp')
         self.assertEqual(msg['payload']['kp'], 10.5)
         
-        print(f"✓ PID gains published: Kp={msg['payload']['kp']}, "
+        log(f"✓ PID gains published: Kp={msg['payload']['kp']}, "
               f"Ki={msg['payload']['ki']}, Kd={msg['payload']['kd']}")
     
     def test_03_publish_wc_prediction(self):
@@ -602,7 +768,7 @@ class TestMQTTIntegration(unittest.TestCase):
         self.assertEqual(msg['payload']['predicted_days_remaining'], 3.5)
         self.assertTrue(msg['payload']['needs_change_soon'])
         
-        print(f"✓ Water change prediction published: {msg['payload']['predicted_days_remaining']} days, "
+        log(f"✓ Water change prediction published: {msg['payload']['predicted_days_remaining']} days, "
               f"confidence={msg['payload']['confidence']:.2f}")
 
 
@@ -613,7 +779,10 @@ class TestEndToEndWorkflow(unittest.TestCase):
     def setUpClass(cls):
         """Set up complete system"""
         try:
+            cls.cache_dir = tempfile.mkdtemp(prefix='aquarium-ml-test-')
+            cls.addClassCleanup(shutil.rmtree, cls.cache_dir, ignore_errors=True)
             cls.service = AquariumMLService(
+                cache_dir=cls.cache_dir,
                 db_host=TEST_DB_HOST,
                 db_port=TEST_DB_PORT,
                 db_name=TEST_DB_NAME,
@@ -624,42 +793,43 @@ class TestEndToEndWorkflow(unittest.TestCase):
                 mqtt_user=TEST_MQTT_USER,
                 mqtt_password=TEST_MQTT_PASSWORD
             )
-            print(f"\n✓ Created unified ML service")
+            log(f"\n✓ Created unified ML service")
         except Exception as e:
             raise unittest.SkipTest(f"Cannot create service: {e}")
     
     def test_complete_workflow(self):
         """Test complete training and prediction workflow"""
-        print("\n=== Running Complete Workflow ===")
+        log("\n=== Running Complete Workflow ===")
         
         # 1. Populate training data (abbreviated for speed)
-        print("\n1. Populating training data...")
+        log("\n1. Populating training data...")
         base_ts = int(time.time())
         
-        # PID performance data
-        for i in range(60):
-            data = {
-                'timestamp': base_ts - (i * 3600),
-                'controller': 'temp',
-                'kp': 10.0 + np.random.randn() * 0.5,
-                'ki': 0.5 + np.random.randn() * 0.05,
-                'kd': 5.0 + np.random.randn() * 0.3,
-                'settling_time': 12.0 + np.random.randn() * 2.0,
-                'overshoot': 0.3 + np.random.randn() * 0.1,
-                'steady_state_error': 0.05,
-                'temperature': 24.5,
-                'ambient_temp': 22.0,
-                'tds': 300.0,
-                'ph': 7.2,
-                'hour': (i * 3) % 24,
-                'season': i % 4,
-                'tank_volume': 200.0
-            }
-            self.service.db.store_pid_performance(data)
+        # PID performance data (one transaction, one commit)
+        with self.service.db.transaction():
+            for i in range(60):
+                data = {
+                    'timestamp': base_ts - (i * 3600),
+                    'controller': 'temp',
+                    'kp': 10.0 + np.random.randn() * 0.5,
+                    'ki': 0.5 + np.random.randn() * 0.05,
+                    'kd': 5.0 + np.random.randn() * 0.3,
+                    'settling_time': 12.0 + np.random.randn() * 2.0,
+                    'overshoot': 0.3 + np.random.randn() * 0.1,
+                    'steady_state_error': 0.05,
+                    'temperature': 24.5,
+                    'ambient_temp': 22.0,
+                    'tds': 300.0,
+                    'ph': 7.2,
+                    'hour': (i * 3) % 24,
+                    'season': i % 4,
+                    'tank_volume': 200.0
+                }
+                self.service.db.store_pid_performance(data)
         
         # Water change data
-        for i in range(15):
-            data = {
+        inserted = self.service.db.store_water_changes_bulk([
+            {
                 'startTime': base_ts - (i * 14 * 86400) - 3600,
                 'endTime': base_ts - (i * 14 * 86400),
                 'volume': 40.0,
@@ -672,18 +842,20 @@ class TestEndToEndWorkflow(unittest.TestCase):
                 'duration': 60,
                 'successful': True
             }
-            self.service.db.store_water_change(data)
+            for i in range(15)
+        ])
+        self.assertEqual(inserted, 15)
         
-        print("✓ Populated 60 PID records and 15 water change events")
+        log("✓ Populated 60 PID records and 15 water change events")
         
         # 2. Train all models
-        print("\n2. Training all models...")
+        log("\n2. Training all models...")
         self.service.train_all_pid_models()
         self.service.train_wc_model()
-        print("✓ Training complete")
+        log("✓ Training complete")
         
         # 3. Generate predictions
-        print("\n3. Generating predictions...")
+        log("\n3. Generating predictions...")
         
         # Store current sensor data
         sensor_data = {
@@ -696,14 +868,15 @@ class TestEndToEndWorkflow(unittest.TestCase):
             'co2State': 'OFF'
         }
         self.service.db.store_sensor_reading(sensor_data)
+        self.service.db.flush_sensor_readings()
         
         # Publish predictions
         self.service.publish_pid_predictions()
         
-        print("✓ Predictions published")
+        log("✓ Predictions published")
         
         # 4. Verify predictions were stored
-        print("\n4. Verifying stored predictions...")
+        log("\n4. Verifying stored predictions...")
         
         cursor = self.service.db.conn.cursor()
         cursor.execute("SELECT COUNT(*) FROM pid_gains")
@@ -716,9 +889,9 @@ class TestEndToEndWorkflow(unittest.TestCase):
         self.assertGreater(pid_count, 0, "No PID gains stored")
         self.assertGreater(wc_count, 0, "No water change predictions stored")
         
-        print(f"✓ Stored {pid_count} PID gain records")
-        print(f"✓ Stored {wc_count} water change predictions")
-        print("\n=== Workflow Complete ===")
+        log(f"✓ Stored {pid_count} PID gain records")
+        log(f"✓ Stored {wc_count} water change predictions")
+        log("\n=== Workflow Complete ===")
 
 
 def run_integration_tests():
@@ -728,13 +901,15 @@ def run_integration_tests():
         print("Skipping integration tests (SKIP_INTEGRATION set)")
         return 0
     
-    print("=" * 70)
-    print("INTEGRATION TESTS FOR UNIFIED AQUARIUM ML SERVICE")
-    print("=" * 70)
-    print(f"\nTest Configuration:")
-    print(f"  Database: {TEST_DB_USER}@{TEST_DB_HOST}:{TEST_DB_PORT}/{TEST_DB_NAME}")
-    print(f"  MQTT Broker: {TEST_MQTT_BROKER}:{TEST_MQTT_PORT}")
-    print()
+    print("\n".join([
+        "=" * 70,
+        "INTEGRATION TESTS FOR UNIFIED AQUARIUM ML SERVICE",
+        "=" * 70,
+        "\nTest Configuration:",
+        f"  Database: {TEST_DB_USER}@{TEST_DB_HOST}:{TEST_DB_PORT}/{TEST_DB_NAME}",
+        f"  MQTT Broker: {TEST_MQTT_BROKER}:{TEST_MQTT_PORT}",
+        ""
+    ]))
     
     # Create test suite
     loader = unittest.TestLoader()
@@ -751,14 +926,16 @@ def run_integration_tests():
     runner = unittest.TextTestRunner(verbosity=2)
     result = runner.run(suite)
     
-    print("\n" + "=" * 70)
-    print("INTEGRATION TEST SUMMARY")
-    print("=" * 70)
-    print(f"Tests run: {result.testsRun}")
-    print(f"Successes: {result.testsRun - len(result.failures) - len(result.errors)}")
-    print(f"Failures: {len(result.failures)}")
-    print(f"Errors: {len(result.errors)}")
-    print(f"Skipped: {len(result.skipped)}")
+    print("\n".join([
+        "\n" + "=" * 70,
+        "INTEGRATION TEST SUMMARY",
+        "=" * 70,
+        f"Tests run: {result.testsRun}",
+        f"Successes: {result.testsRun - len(result.failures) - len(result.errors)}",
+        f"Failures: {len(result.failures)}",
+        f"Errors: {len(result.errors)}",
+        f"Skipped: {len(result.skipped)}"
+    ]))
     
     # Return exit code
     return 0 if result.wasSuccessful() else 1